@@ -6,12 +6,14 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 import chromedriver_autoinstaller
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
-import time
 from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.webdriver.support import expected_conditions as EC
 from bs4 import BeautifulSoup
 import requests
 
+from session_cache import restore_session, save_session
+from readiness import wait_for_amount, wait_for_text
+
 def send_slack_message(card1_money_amount, card2_money_amount):
     load_dotenv()
     SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
@@ -38,9 +40,8 @@ def get_money_amount(driver):
     #カード明細ページへ
     driver.get(card_detail_url)
 
-    #金額表示の親要素を特定
-    parent_div = driver.find_element(By.CLASS_NAME, "stmt-about-payment__money__main__num")
-    div_html_content = parent_div.get_attribute('outerHTML')
+    #金額表示の親要素が描画されるまで待機
+    div_html_content = wait_for_amount(driver)
     soup = BeautifulSoup(div_html_content, 'html.parser')
     money_span = soup.find('span', class_='stmt-u-font-roboto')
 
@@ -73,39 +74,43 @@ def get_website_content(url):
     
     try:
         driver = webdriver.Chrome(service=service, options=options)
-        driver.implicitly_wait(5) 
-        driver.get(target_url) # 対象のURLをここに記述してください
+        # 保存済みのセッションが有効ならログインをスキップする
+        if not restore_session(driver, card_detail_url):
+            driver.get(target_url) # 対象のURLをここに記述してください
 
-        # 明示的な待機: ID 'user_id' を持つ要素がDOMに存在し、可視になるまで最大10秒待機
-        idForm = WebDriverWait(driver, 10).until(
-            EC.visibility_of_element_located((By.ID, "user_id"))
-        )
+            # 明示的な待機: ID 'user_id' を持つ要素がDOMに存在し、可視になるまで最大10秒待機
+            idForm = WebDriverWait(driver, 10).until(
+                EC.visibility_of_element_located((By.ID, "user_id"))
+            )
 
-        # inputにテキストを送信
-        idForm.send_keys(id)
+            # inputにテキストを送信
+            idForm.send_keys(id)
 
-        #次へボタン 親要素を特定
-        parent_div = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.ID, "cta001")) # クリック可能になるまで待つ
-        )
-        #次へボタン を特定しクリック
-        next_button = parent_div.find_element(By.XPATH, ".//div[text()='次へ']").click()
+            #次へボタン 親要素を特定
+            parent_div = WebDriverWait(driver, 10).until(
+                EC.element_to_be_clickable((By.ID, "cta001")) # クリック可能になるまで待つ
+            )
+            #次へボタン を特定しクリック
+            next_button = parent_div.find_element(By.XPATH, ".//div[text()='次へ']").click()
 
         
-        pwForm = WebDriverWait(driver, 10).until(
-            EC.visibility_of_element_located((By.ID, "password_current"))
-        )
+            pwForm = WebDriverWait(driver, 10).until(
+                EC.visibility_of_element_located((By.ID, "password_current"))
+            )
         
-        #inputにテキストを送信
-        pwForm.send_keys(pw)
-
-        #次へボタン親要素を特定
-        parent_div = WebDriverWait(driver, 10).until(
-            EC.element_to_be_clickable((By.ID, "cta011")) # クリック可能になるまで待つ
-        )
-        #次へボタン を特定しクリック
-        next_button = parent_div.find_element(By.XPATH, ".//div[text()='次へ']").click()
-        time.sleep(5)
+            #inputにテキストを送信
+            pwForm.send_keys(pw)
+
+            #次へボタン親要素を特定
+            parent_div = WebDriverWait(driver, 10).until(
+                EC.element_to_be_clickable((By.ID, "cta011")) # クリック可能になるまで待つ
+            )
+            #次へボタン を特定しクリック
+            next_button = parent_div.find_element(By.XPATH, ".//div[text()='次へ']").click()
+            # 固定のsleepの代わりに、ログイン後のページが表示されるまで待つ
+            wait_for_text(driver, "ようこそ", "welcome")
+            # ログイン完了後のCookieを次回のために保存する
+            save_session(driver)
         
         card1_money_amount, driver = get_money_amount(driver)
         #カード切り替え
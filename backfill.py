@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+
+import local_env  # noqa: F401  (.env をほかのモジュールより先に読み込む)
+import delivery
+from driver_manager import get_driver, discard_driver
+from session_cache import restore_session, save_session, load_session, clear_session
+from card_tabs import list_cards, iter_statements_in_tabs
+from readiness import wait_for_amount
+from tracing import start_run, span, record, print_summary, run_spans
+from steps import Checkpoint, run_step
+from scheduler import JST
+import history_store
+from main import CARD_DETAIL_URL, LOGIN_USER_ID, LOGIN_PASSWORD, SLACK_WEBHOOK_URL, login, wait_for_welcome
+
+# 過去の明細の取得方法: http (ログイン後のCookieでまとめて取得) / browser (1つのブラウザの複数のタブで取得)
+BACKFILL_MODE = os.getenv("BACKFILL_MODE", "http")
+# ブラウザで取得する場合に同時に開くタブの数
+BACKFILL_MAX_TABS = int(os.getenv("BACKFILL_MAX_TABS", "6"))
+# 明細の月を切り替えるクエリパラメータ (0が今月の明細、1が前月の明細、...)
+STATEMENT_TAB_PARAM = os.getenv("STATEMENT_TAB_PARAM", "tabNo")
+
+
+def statement_url(tab_no, base_url=None):
+    """明細ページのURLの月 (tabNo) を差し替える"""
+    url = urlparse(base_url or CARD_DETAIL_URL)
+    query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+    query[STATEMENT_TAB_PARAM] = str(tab_no)
+    return urlunparse(url._replace(query=urlencode(query)))
+
+
+def month_offset(month, now=None):
+    """明細の月 ('2024-06') が今月 (日本時間) の何か月前か"""
+    today = datetime.fromtimestamp(time.time() if now is None else now, JST)
+    year, month_number = map(int, month.split("-"))
+    return (today.year - year) * 12 + today.month - month_number
+
+
+def backfill_pages(months=None, start=None, end=None, now=None):
+    """
+    取得する明細ページの (tabNo, URL) のリストを返す。
+    months なら今月から months か月分、start/end ('YYYY-MM') ならその範囲の月。
+    """
+    if start or end:
+        first = month_offset(end, now) if end else 0
+        last = month_offset(start, now) if start else first
+        tab_numbers = range(max(first, 0), last + 1)
+    else:
+        tab_numbers = range(months or 1)
+    return [(tab_no, statement_url(tab_no)) for tab_no in tab_numbers]
+
+
+def _to_record(tab_no, card_amount):
+    """取得したカードの明細に、どの月のページから取得したかを加える"""
+    return {
+        "tab_no": tab_no,
+        "month": history_store.statement_month(card_amount["payment_date"]),
+        **{k: v for k, v in card_amount.items() if k != "value"},
+    }
+
+
+def _to_error(tab_no, card, error):
+    print(f"明細 ({STATEMENT_TAB_PARAM}={tab_no}, カード{card['index'] if card else '-'}) の取得に失敗しました: {type(error).__name__}: {error}")
+    return {"tab_no": tab_no, "card": card["index"] if card else None, "error": f"{type(error).__name__}: {error}"}
+
+
+def _saved_http_session(account=None):
+    """保存済みのセッションが有効ならそのCookieのHTTPセッションを返す。無効ならNone"""
+    import requests
+    from http_fetch import build_http_session, fetch_statement, SessionExpiredError
+
+    cookies = load_session(account)
+    if not cookies:
+        return None
+    session = build_http_session(cookies)
+    try:
+        fetch_statement(session, CARD_DETAIL_URL)
+        return session
+    except SessionExpiredError as e:
+        print(f"保存済みのセッションが無効です。ブラウザでログインします: {e}")
+        clear_session(account)
+    except requests.exceptions.RequestException as e:
+        print(f"保存済みのセッションを確認できませんでした。ブラウザでログインします: {e}")
+    return None
+
+
+def _login_browser(user_id, password, account=None):
+    """ブラウザを起動してログインし、明細ページを表示した状態のドライバを返す"""
+    checkpoint = Checkpoint(account)
+    with span("driver_launch") as attrs:
+        driver, attrs["start_type"] = get_driver()
+    if not restore_session(driver, CARD_DETAIL_URL, account):
+        run_step(checkpoint, "login", lambda: login(driver, user_id, password))
+        run_step(checkpoint, "welcome", lambda: wait_for_welcome(driver))
+        save_session(driver, account)
+        driver.get(CARD_DETAIL_URL)
+    return driver
+
+
+def iter_backfill(pages, card_indexes=None, mode=None, user_id=None, password=None, account=None):
+    """
+    pages (backfill_pages の戻り値) の各月の明細を同時に取得し、取得できたものから結果を返す。
+    http では保存済みのセッション (なければブラウザでログインした後のCookie) でまとめて取得し、
+    browser ではログインしたブラウザの複数のタブで取得する。
+    """
+    mode = mode or BACKFILL_MODE
+    user_id = user_id or LOGIN_USER_ID
+    password = password or LOGIN_PASSWORD
+
+    if mode == "http":
+        from http_fetch import build_http_session, cookies_from_driver, iter_statements
+
+        session = _saved_http_session(account)
+        if session is None:
+            session = build_http_session(cookies_from_driver(_login_browser(user_id, password, account)))
+        for tab_no, card, result in iter_statements(session, pages, card_indexes):
+            if isinstance(result, Exception):
+                yield _to_error(tab_no, card, result)
+            else:
+                yield _to_record(tab_no, {
+                    "card": card["index"],
+                    "label": card["label"],
+                    "amount": result["total"],
+                    "payment_date": result["payment_date"],
+                    "items": result["items"],
+                })
+        return
+
+    driver = _login_browser(user_id, password, account)
+    wait_for_amount(driver, "statement")
+    cards = [c for c in list_cards(driver) if card_indexes is None or c["index"] in card_indexes]
+    for tab_no, card, result in iter_statements_in_tabs(driver, pages, cards, BACKFILL_MAX_TABS):
+        if isinstance(result, Exception):
+            yield _to_error(tab_no, card, result)
+        else:
+            yield _to_record(tab_no, result)
+
+
+def save_backfill(run_id, records, account=None):
+    """取得した過去の明細を履歴 (明細の月ごとのパーティション) に追加する"""
+    if not history_store.HISTORY_ENABLED:
+        return
+    card_amounts = [r for r in records if "error" not in r]
+    # 過去の明細は比べる相手がないので、利用明細もすべて保存する
+    history_store.append_cards(run_id, card_amounts, card_amounts, account)
+
+
+def run_backfill(pages, card_indexes=None, mode=None, account=None, on_result=None, save_history=True, run_id=None):
+    """
+    過去の明細をまとめて取得し、(成功した結果, 失敗した結果) を返す。
+    on_result には取得できたものから1件ずつ渡す。
+    """
+    records, errors = [], []
+    with span("backfill", pages=len(pages), mode=mode or BACKFILL_MODE):
+        for result in iter_backfill(pages, card_indexes, mode, account=account):
+            (errors if "error" in result else records).append(result)
+            if on_result:
+                on_result(result)
+    if save_history and records:
+        save_backfill(run_id or f"backfill-{int(time.time())}", records, account)
+    print(f"過去の明細を取得しました。成功: {len(records)}件, 失敗: {len(errors)}件")
+    return records, errors
+
+
+# --- 過去の明細をまとめて取り込むLambdaのハンドラ ---
+def handler(event, context):
+    """
+    event の例: {"months": 12} / {"start": "2024-01", "end": "2024-12", "cards": [1, 2], "mode": "browser"}
+    """
+    started_at = time.time()
+    run_id = start_run(getattr(context, "aws_request_id", None))
+    pages = backfill_pages(event.get("months"), event.get("start"), event.get("end"))
+    failed = True
+    try:
+        records, errors = run_backfill(pages, event.get("cards"), event.get("mode"), run_id=run_id)
+        failed = False
+    except Exception:
+        # 状態が分からないブラウザは次の実行に使い回さない
+        discard_driver()
+        raise
+    finally:
+        record("total", (time.time() - started_at) * 1000, "error" if failed else "ok")
+        history_store.append_run(run_id, None, run_spans(), run_status="error" if failed else "ok")
+        delivery.flush(SLACK_WEBHOOK_URL, context)
+        if not os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+            print_summary()
+
+    return {
+        'statusCode': 200 if not errors else 207,
+        'runId': run_id,
+        'results': [{k: v for k, v in r.items() if k != "items"} for r in records],
+        'errors': errors,
+        'body': f'Backfill completed. succeeded: {len(records)}, failed: {len(errors)}'
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="過去の月の明細をまとめて取得して履歴に追加する")
+    parser.add_argument("--months", type=int, default=12, help="今月から何か月分を取得するか")
+    parser.add_argument("--start", help="取得する最初の月 (YYYY-MM)。指定すると --months より優先する")
+    parser.add_argument("--end", help="取得する最後の月 (YYYY-MM)")
+    parser.add_argument("--cards", help="取得するカードの番号 (カンマ区切り、未指定なら全カード)")
+    parser.add_argument("--mode", choices=("http", "browser"), help=f"取得方法 (既定: {BACKFILL_MODE})")
+    parser.add_argument("--output", help="取得できたものから1行ずつJSONで書き出すファイル")
+    parser.add_argument("--no-history", action="store_true", help="履歴に保存しない")
+    args = parser.parse_args(argv)
+
+    card_indexes = {int(c) for c in args.cards.split(",")} if args.cards else None
+    pages = backfill_pages(args.months, args.start, args.end)
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+
+    def on_result(result):
+        if output:
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+        if "error" not in result:
+            print(f"[{result['month']}] カード{result['card']} ({result['label']}): {result['amount']}円 (明細{len(result['items'])}件)")
+
+    started = time.perf_counter()
+    try:
+        _, errors = run_backfill(pages, card_indexes, args.mode, on_result=on_result, save_history=not args.no_history)
+    finally:
+        if output:
+            output.close()
+        discard_driver()
+        # 履歴のアップロードとまとめる処理の完了を待つ
+        delivery.flush()
+    print(f"所要時間: {time.perf_counter() - started:.1f}秒")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
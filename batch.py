@@ -0,0 +1,242 @@
+import os
+import time
+import queue
+import threading
+
+import local_env  # noqa: F401  (.env をほかのモジュールより先に読み込む)
+from driver_manager import launch_driver, is_driver_healthy, reset_driver_state
+import delivery
+from main import (
+    scrape_account, try_fetch_cards_without_browser, format_card_amounts, send_slack_message,
+    NOTIFY_ONLY_ON_CHANGE, PRECHECK_WITHOUT_BROWSER, SLACK_WEBHOOK_URL,
+)
+from state_store import update_states, mark_notified
+from steps import Checkpoint
+from tracing import start_run, span, record, run_spans
+from history_store import append_run
+import scheduler
+
+# 1ブラウザあたりのメモリ使用量の目安 (MB)。プールの大きさをLambdaのメモリから決めるのに使う
+BROWSER_MEMORY_MB = int(os.getenv("BROWSER_MEMORY_MB", "512"))
+# 同時に起動するブラウザの数 (未設定ならメモリから決める)
+BATCH_POOL_SIZE = os.getenv("BATCH_POOL_SIZE")
+# 1アカウントあたりの処理時間の上限 (秒)
+ACCOUNT_TIMEOUT_SEC = float(os.getenv("ACCOUNT_TIMEOUT_SEC", "120"))
+# ウォッチドッグがタイムアウトを確認する間隔 (秒)
+WATCHDOG_INTERVAL_SEC = 0.5
+
+
+def pool_size_for_memory():
+    """Lambdaに割り当てられたメモリから、同時に起動できるブラウザの数を決める"""
+    if BATCH_POOL_SIZE:
+        return max(1, int(BATCH_POOL_SIZE))
+    memory_mb = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "2048"))
+    # Python本体などの分として1ブラウザ分を残す
+    return max(1, memory_mb // BROWSER_MEMORY_MB - 1)
+
+
+class _Worker(threading.Thread):
+    """
+    1つのブラウザを持ち、キューからアカウントを取り出して順に処理するワーカー。
+    アカウントの間ではCookieとタブを消去し、失敗したらブラウザを起動し直す。
+    """
+
+    def __init__(self, slot, accounts, results):
+        super().__init__(name=f"batch-worker-{slot}", daemon=True)
+        self.slot = slot
+        self.accounts = accounts
+        self.results = results
+        self.lock = threading.Lock()
+        self.driver = None
+        self.current = None
+        self.deadline = None
+        self.timed_out = False
+
+    def run(self):
+        while True:
+            try:
+                index, account = self.accounts.get_nowait()
+            except queue.Empty:
+                break
+            self.results[index] = self._process(account)
+        self._quit_driver()
+
+    def _process(self, account):
+        name = account.get("name") or f"account-{account['id'][-4:]}"
+        started = time.perf_counter()
+        with self.lock:
+            self.timed_out = False
+        try:
+            # 保存済みのセッションが有効ならブラウザを使わずにHTTPだけで取得する
+            cards = try_fetch_cards_without_browser(account["id"]) if PRECHECK_WITHOUT_BROWSER else None
+            if cards is None:
+                cards = self._scrape_in_browser(name, account)
+            changed, unnotified = update_states(cards, account=account["id"])
+            # 一部のカードの金額を取得できなかったアカウントも失敗として通知する。
+            # カードごとの取得は失敗を結果に残して続けるので、打ち切られても例外にならないことがある
+            missing = [c["card"] for c in cards if c["amount"] is None]
+            status = "timeout" if self.timed_out else "partial" if missing else "ok"
+            error = f"カード{missing}の金額を取得できませんでした" if missing else None
+            if self.timed_out:
+                error = f"{ACCOUNT_TIMEOUT_SEC}秒を超えたため打ち切りました" + (f" ({error})" if error else "")
+                # ウォッチドッグが終了させたブラウザは使えない
+                self._quit_driver()
+        except Exception as e:
+            status = "timeout" if self.timed_out else "error"
+            error = f"{type(e).__name__}: {e}"
+            print(f"アカウント {name} の処理に失敗しました: {error}")
+            cards = None
+            changed = unnotified = []
+            # 状態が分からないブラウザは次のアカウントに使い回さない
+            self._quit_driver()
+        finally:
+            with self.lock:
+                self.current = None
+                self.deadline = None
+
+        record("account", (time.perf_counter() - started) * 1000, status, account=name, slot=self.slot)
+        return {
+            "account": name,
+            "account_id": account["id"],
+            "status": status,
+            "error": error,
+            "cards": cards,
+            "changed": [c["card"] for c in changed],
+            "unnotified": [c["card"] for c in unnotified],
+        }
+
+    def _scrape_in_browser(self, name, account):
+        """ワーカーのブラウザでログインして全カードを取得する (ブラウザは必要になったときに起動する)"""
+        if self.driver is None or not is_driver_healthy(self.driver):
+            self._quit_driver()
+            with span("driver_launch", account=name, slot=self.slot):
+                self.driver = launch_driver(self.slot)
+        else:
+            reset_driver_state(self.driver)
+
+        with self.lock:
+            self.current = name
+            self.deadline = time.monotonic() + ACCOUNT_TIMEOUT_SEC
+        # 前回途中で失敗していれば、取得済みのカードは取り直さない
+        checkpoint = Checkpoint.load(account["id"])
+        cards = scrape_account(self.driver, account["id"], account["pw"], account=account["id"], checkpoint=checkpoint)
+        # 取得が終わった後はウォッチドッグにブラウザを終了させない
+        with self.lock:
+            self.deadline = None
+        if all(c["amount"] is not None for c in cards):
+            checkpoint.clear()
+        return cards
+
+    def check_timeout(self):
+        """処理中のアカウントが上限時間を超えていればブラウザを終了させて処理を打ち切る"""
+        with self.lock:
+            if self.deadline is None or time.monotonic() < self.deadline:
+                return
+            print(f"アカウント {self.current} が {ACCOUNT_TIMEOUT_SEC} 秒を超えたため打ち切ります。")
+            self.timed_out = True
+            self.deadline = None
+            driver = self.driver
+        # ブラウザを終了すると、ワーカーで待機中のWebDriverの呼び出しが例外で戻る
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception as e:
+                print(f"WebDriverの終了中にエラーが発生しました: {e}")
+
+    def _quit_driver(self):
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            except Exception as e:
+                print(f"WebDriverの終了中にエラーが発生しました: {e}")
+            self.driver = None
+
+
+def run_batch(accounts, pool_size=None):
+    """
+    複数アカウントを、上限つきのブラウザのプールで並行して処理する。
+    Lambdaには /dev/shm がなく multiprocessing.Pool が使えないため、
+    ブラウザ (別プロセス) ごとにスレッドを1つ割り当てる。
+    """
+    pool_size = min(pool_size or pool_size_for_memory(), len(accounts)) or 1
+    print(f"{len(accounts)}件のアカウントを{pool_size}個のブラウザで処理します。")
+
+    pending = queue.Queue()
+    for index, account in enumerate(accounts):
+        pending.put((index, account))
+    results = [None] * len(accounts)
+
+    workers = [_Worker(slot, pending, results) for slot in range(pool_size)]
+    for worker in workers:
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.check_timeout()
+        time.sleep(WATCHDOG_INTERVAL_SEC)
+    return results
+
+
+def format_batch_results(results):
+    """アカウントごとの結果をまとめたSlackの本文を組み立てる"""
+    sections = []
+    for result in results:
+        if result["status"] == "ok":
+            sections.append(f"[{result['account']}]\n{format_card_amounts(result['cards'])}")
+        elif result["cards"]:
+            sections.append(f"[{result['account']}] 一部取得失敗 ({result['status']})\n{format_card_amounts(result['cards'])}")
+        else:
+            sections.append(f"[{result['account']}]\n取得失敗 ({result['status']}): {result['error']}")
+    return "\n\n".join(sections)
+
+
+# --- 複数アカウントをまとめて処理するLambdaのハンドラ ---
+def handler(event, context):
+    """
+    event の例: {"accounts": [{"name": "家族A", "id": "...", "pw": "..."}, ...], "pool_size": 3}
+    ("force": true でスケジューラの判断に関係なくすべてのアカウントを確認する)
+    """
+    started_at = time.time()
+    run_id = start_run(getattr(context, "aws_request_id", None))
+    accounts = event.get("accounts") or []
+    if not accounts:
+        return {'statusCode': 400, 'runId': run_id, 'body': 'No accounts given.'}
+    if scheduler.SCHEDULER_ENABLED and not event.get("force"):
+        # 明細が変わりそうなアカウントだけを確認する
+        accounts = [a for a in accounts if scheduler.decide(account=a["id"])["run"]]
+        if not accounts:
+            print("どのアカウントも今回は確認しないため、ブラウザを起動しません。")
+            return {'statusCode': 200, 'runId': run_id, 'skipped': True, 'results': [], 'body': 'Skipped: no account is due.'}
+
+    results = run_batch(accounts, event.get("pool_size"))
+    # 明細に変化があった (前回通知し損ねた変化を含む) か、失敗したアカウントだけを通知する
+    to_notify = [r for r in results if r["status"] != "ok" or r["unnotified"] or not NOTIFY_ONLY_ON_CHANGE]
+
+    def on_sent():
+        for r in to_notify:
+            if r["unnotified"]:
+                mark_notified([c for c in r["cards"] if c["card"] in r["unnotified"]], account=r["account_id"])
+
+    if to_notify:
+        # 送信に成功するまでは通知済みとして記録しない
+        send_slack_message(format_batch_results(to_notify), on_sent=on_sent)
+    else:
+        print("どのアカウントも前回から明細に変化がないため、Slack通知をスキップします。")
+
+    failed = [r for r in results if r["status"] != "ok"]
+    record("batch_total", (time.time() - started_at) * 1000, "error" if failed else "ok", accounts=len(accounts))
+    # アカウントごとのカードの金額と、バッチ全体のフェーズの所要時間を履歴に追加する
+    for r in results:
+        if r["cards"]:
+            changed = [c for c in r["cards"] if c["card"] in r["changed"]]
+            append_run(run_id, r["cards"], [], changed, run_status=r["status"], account=r["account_id"])
+    append_run(run_id, None, run_spans(), run_status="error" if failed else "ok")
+    delivery.flush(SLACK_WEBHOOK_URL, context)
+
+    print(f"バッチ処理が完了しました。成功: {len(results) - len(failed)}件, 失敗: {len(failed)}件")
+    return {
+        'statusCode': 200 if not failed else 207,
+        'runId': run_id,
+        # ログインIDは応答に含めない
+        'results': [{k: v for k, v in r.items() if k != "account_id"} for r in results],
+        'body': f'Batch completed. succeeded: {len(results) - len(failed)}, failed: {len(failed)}'
+    }
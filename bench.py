@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+
+import fixture_server
+
+# 基準値を保存するファイル
+BENCH_BASELINE_PATH = os.getenv("BENCH_BASELINE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json"))
+# 基準値のp95からどれだけ遅くなったら失敗とするか (割合)
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "0.2"))
+# 短いフェーズがゆらぎで失敗しないように、割合に加えて許容する時間 (ミリ秒)
+BENCH_TOLERANCE_MS = float(os.getenv("BENCH_TOLERANCE_MS", "50"))
+# メモリを測る間隔 (秒)
+MEMORY_SAMPLE_INTERVAL_SEC = 0.05
+# 起動時間の計測で、子プロセスが結果の行につける印
+_STARTUP_MARKER = "BENCH_STARTUP "
+
+
+def _process_tree_rss_kb(root_pid):
+    """root_pid とその子孫 (chromedriver と Chrome) のRSSの合計 (KB) を /proc から求める。取れなければNone"""
+    try:
+        pids = [int(p) for p in os.listdir("/proc") if p.isdigit()]
+    except FileNotFoundError:
+        return None
+
+    children = {}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # comm に空白や括弧が含まれることがあるので、最後の ')' の後ろを読む
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class _MemorySampler(threading.Thread):
+    """実行中にプロセスツリーのRSSを定期的に測り、最大値を記録する"""
+
+    def __init__(self):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            rss_kb = _process_tree_rss_kb(os.getpid())
+            if rss_kb is None:
+                return
+            self.peak_kb = max(self.peak_kb, rss_kb)
+            self.stopped.wait(MEMORY_SAMPLE_INTERVAL_SEC)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        if self.peak_kb:
+            return self.peak_kb / 1024
+        # /proc がない環境では getrusage の最大RSSで代用する (Linux は KB、macOS はバイト)
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return usage / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def _prepare_env(url, server, work_dir):
+    """main.py をフィクスチャサーバーに向け、Slack、S3、キャッシュの保存先をローカルに閉じる"""
+    os.environ.update(fixture_server.site_env(url, server))
+    os.environ.update({
+        # .env に本番の値があっても load_dotenv は既存の環境変数を上書きしない
+        "SLACK_WEBHOOK_URL": "",
+        # スケジューラが実行を飛ばすと計測にならない
+        "SCHEDULER_ENABLED": "0",
+        "SESSION_CACHE_BUCKET": "",
+        "STATE_BUCKET": "",
+        "SCREENSHOT_BUCKET": "",
+        "HTML_SOURCE_BUCKET": "",
+        "SESSION_CACHE_PATH": os.path.join(work_dir, "enavi_session.json"),
+        "STATE_DIR": os.path.join(work_dir, "state"),
+        "CHECKPOINT_DIR": os.path.join(work_dir, "checkpoint"),
+        "HISTORY_DIR": os.path.join(work_dir, "history"),
+        "HISTORY_BUCKET": "",
+        "NOTIFY_ONLY_ON_CHANGE": "0",
+    })
+
+
+def _clear_caches(work_dir):
+    """保存済みのセッション、状態、チェックポイント、履歴を消し、次の実行でブラウザからログインさせる"""
+    for name in os.listdir(work_dir):
+        path = os.path.join(work_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def run_benchmark(runs=5, fresh=True, **server_options):
+    """
+    フィクスチャサーバーに対して main.handler を runs 回実行し、
+    フェーズごとのp50/p95、ピークメモリ、実行ごとの結果を返す。
+    fresh=True なら毎回セッションを消して、ブラウザでのログインから計測する。
+    """
+    server, url = fixture_server.start_in_background(**server_options)
+    work_dir = tempfile.mkdtemp(prefix="enavi_bench_")
+    _prepare_env(url, server, work_dir)
+
+    # 環境変数を設定してから読み込む (設定値はモジュールの読み込み時に決まる)
+    import main as scraper
+    import tracing
+    from driver_manager import discard_driver
+
+    tracing.reset()
+    sampler = _MemorySampler()
+    sampler.start()
+    results = []
+    try:
+        for index in range(runs):
+            if fresh:
+                _clear_caches(work_dir)
+            started = time.perf_counter()
+            response = scraper.handler({}, None)
+            results.append({
+                "run": index + 1,
+                "ok": response["statusCode"] == 200,
+                "status_code": response["statusCode"],
+                "start_type": response.get("startType"),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            })
+    finally:
+        discard_driver()
+        peak_rss_mb = sampler.stop()
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "settings": {
+            "runs": runs,
+            "fresh": fresh,
+            "latency_ms": server.latency_ms,
+            "jitter_ms": server.jitter_ms,
+            "render_delay_ms": server.render_delay_ms,
+            "cards": len(server.cards),
+            "items": len(server.cards[0]["items"]) if server.cards else 0,
+        },
+        "phases": tracing.summarize(),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "runs": results,
+    }
+
+
+def probe_startup():
+    """
+    (新しいプロセスで呼ばれる) main の読み込みとChromeの初回起動にかかる時間を測り、1行のJSONで出力する。
+    Seleniumの読み込み、プロファイルの準備、Chromeの起動は launch_driver のスパンから取る。
+    """
+    started = time.perf_counter()
+    import main as scraper  # noqa: F401  読み込み時間を測るためだけに読み込む
+    import_ms = (time.perf_counter() - started) * 1000
+
+    import tracing
+    from driver_manager import launch_driver
+
+    driver = launch_driver()
+    try:
+        rss_kb = _process_tree_rss_kb(os.getpid())
+    finally:
+        driver.quit()
+    phases = {phase: stats["p50_ms"] for phase, stats in tracing.summarize().items()}
+    print(_STARTUP_MARKER + json.dumps({"import": round(import_ms, 1), **phases, "rss_kb": rss_kb}))
+
+
+def run_startup_benchmark(runs=5):
+    """
+    コールドスタートを再現するため、毎回新しいプロセスと空の /tmp で probe_startup を実行し、
+    読み込み時間とChromeの初回起動時間を別々に集計する。
+    """
+    import tracing
+
+    tracing.reset()
+    results = []
+    peak_rss_mb = 0
+    for index in range(runs):
+        tmp_dir = tempfile.mkdtemp(prefix="enavi_startup_")
+        env = {**os.environ, "CHROME_TMP_DIR": tmp_dir}
+        started = time.perf_counter()
+        try:
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--probe-startup"],
+                env=env, capture_output=True, text=True,
+            )
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        line = next((l for l in completed.stdout.splitlines() if l.startswith(_STARTUP_MARKER)), None)
+        if completed.returncode != 0 or line is None:
+            print(f"起動時間の計測に失敗しました (終了コード {completed.returncode}):\n{completed.stderr[-2000:]}")
+            results.append({"run": index + 1, "ok": False, "duration_ms": duration_ms})
+            continue
+        measured = json.loads(line[len(_STARTUP_MARKER):])
+        rss_kb = measured.pop("rss_kb", None)
+        if rss_kb:
+            peak_rss_mb = max(peak_rss_mb, rss_kb / 1024)
+        for phase, duration in measured.items():
+            tracing.record(phase, duration)
+        results.append({"run": index + 1, "ok": True, "duration_ms": duration_ms})
+
+    return {
+        "settings": {"startup_runs": runs},
+        "phases": tracing.summarize(),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "runs": results,
+    }
+
+
+def compare_to_baseline(report, baseline, tolerance=None, tolerance_ms=None):
+    """基準値よりp95が許容範囲を超えて遅くなったフェーズ (とメモリ) の一覧を返す"""
+    tolerance = BENCH_TOLERANCE if tolerance is None else tolerance
+    tolerance_ms = BENCH_TOLERANCE_MS if tolerance_ms is None else tolerance_ms
+    regressions = []
+    for phase, expected in baseline.get("phases", {}).items():
+        actual = report["phases"].get(phase)
+        if actual is None:
+            continue
+        limit = expected["p95_ms"] * (1 + tolerance) + tolerance_ms
+        if actual["p95_ms"] > limit:
+            regressions.append(f"{phase}: p95 {actual['p95_ms']:.1f}ms > {limit:.1f}ms (基準 {expected['p95_ms']:.1f}ms)")
+    expected_rss = baseline.get("peak_rss_mb")
+    if expected_rss and report["peak_rss_mb"] > expected_rss * (1 + tolerance):
+        regressions.append(f"peak_rss: {report['peak_rss_mb']:.1f}MB > {expected_rss * (1 + tolerance):.1f}MB (基準 {expected_rss:.1f}MB)")
+    return regressions
+
+
+def print_report(report):
+    """計測結果を表形式で表示する"""
+    print(f"\n{'phase':<28}{'count':>6}{'p50(ms)':>12}{'p95(ms)':>12}")
+    for phase, stats in report["phases"].items():
+        print(f"{phase:<28}{stats['count']:>6}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}")
+    print(f"ピークメモリ (プロセスツリーのRSS): {report['peak_rss_mb']:.1f}MB")
+    for run in report["runs"]:
+        print(f"実行{run['run']}: {'成功' if run['ok'] else '失敗'} {run.get('start_type') or ''} {run['duration_ms']:.1f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ローカルのe-naviフィクスチャに対して handler を実行し、フェーズごとの所要時間を計測する")
+    parser.add_argument("--runs", type=int, default=5, help="handler を実行する回数")
+    parser.add_argument("--reuse-session", action="store_true", help="実行の間でセッションを消さない (2回目以降はHTTPのみの経路になる)")
+    parser.add_argument("--latency-ms", type=float, help="フィクスチャの応答に加える遅延")
+    parser.add_argument("--jitter-ms", type=float, help="遅延のゆらぎの幅")
+    parser.add_argument("--render-delay-ms", type=int, help="金額をJavaScriptで描画するまでの時間")
+    parser.add_argument("--cards", type=int, help="カードの枚数")
+    parser.add_argument("--items", type=int, help="1枚あたりの利用明細の件数")
+    parser.add_argument("--baseline", default=BENCH_BASELINE_PATH, help="基準値のファイル")
+    parser.add_argument("--check", action="store_true", help="基準値より遅くなっていれば失敗する")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果を基準値として保存する")
+    parser.add_argument("--output", help="計測結果をJSONで書き出すファイル")
+    parser.add_argument("--startup", action="store_true", help="handler の代わりに、読み込み時間とChromeの初回起動時間を新しいプロセスで測る")
+    parser.add_argument("--probe-startup", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.probe_startup:
+        probe_startup()
+        return 0
+
+    if args.startup:
+        report = run_startup_benchmark(args.runs)
+    else:
+        cards = None
+        if args.cards is not None or args.items is not None:
+            cards = fixture_server.make_cards(args.cards, args.items)
+        report = run_benchmark(
+            runs=args.runs,
+            fresh=not args.reuse_session,
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            render_delay_ms=args.render_delay_ms,
+            cards=cards,
+        )
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed_runs = [r for r in report["runs"] if not r["ok"]]
+    if failed_runs:
+        print(f"エラー: {len(failed_runs)}回の実行が失敗しました。")
+        return 1
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({k: report[k] for k in ("settings", "phases", "peak_rss_mb")}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"基準値を {args.baseline} に保存しました。")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print(f"エラー: 基準値のファイル {args.baseline} がありません。--update-baseline で作成してください。")
+            return 2
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != report["settings"]:
+            print(f"警告: 基準値と計測条件が異なります。基準: {baseline.get('settings')}")
+        regressions = compare_to_baseline(report, baseline)
+        if regressions:
+            print("基準値より遅くなりました:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("基準値の範囲内です。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
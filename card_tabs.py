@@ -0,0 +1,227 @@
+from selenium.common.exceptions import WebDriverException
+
+from readiness import wait_for_amount, wait_for_statement, mark_amount_stale
+from network_profile import apply_network_profile
+from statement import CARD_SELECT_ID, CardMismatchError, check_selected_card, from_extracted
+from tracing import span
+
+# カードごとに失敗として扱う例外 (他のカードの取得は続ける)
+_CARD_ERRORS = (WebDriverException, CardMismatchError)
+
+# ドロップダウンがない (カードが1枚の) 場合は空のリストを返す
+_LIST_CARDS_SCRIPT = """
+const select = document.getElementById(arguments[0]);
+if (!select) return [];
+return Array.from(select.options).map(o => ({value: o.value, label: o.text.trim(), selected: o.selected}));
+"""
+
+# select_by_value と同じく値を変えてchangeイベントを発火させる (JSFのonchangeで送信される)。
+# execute_script はページ遷移を待たずに戻るので、複数のタブで同時に切り替えられる。
+_SWITCH_CARD_SCRIPT = """
+const select = document.getElementById(arguments[0]);
+select.value = arguments[1];
+select.dispatchEvent(new Event('change', {bubbles: true}));
+"""
+
+
+def list_cards(driver):
+    """表示中の明細ページのカード切り替えドロップダウンから全カードの一覧を取得する"""
+    cards = driver.execute_script(_LIST_CARDS_SCRIPT, CARD_SELECT_ID)
+    if not cards:
+        cards = [{"value": None, "label": "カード1", "selected": True}]
+    for index, card in enumerate(cards, start=1):
+        card["index"] = index
+    print(f"カードが{len(cards)}枚見つかりました: {[c['label'] for c in cards]}")
+    return cards
+
+
+def _to_result(driver, card, payload):
+    """
+    取り出した明細を解析し、カードの結果を返す。
+    明細が複数ページに分かれている場合は、同じタブで続きのページも読み取る。
+    いずれかのページが card 以外のカードを表示していれば CardMismatchError を送出する。
+    """
+    with span("parse", card=card["index"]):
+        statement = from_extracted(payload)
+    check_selected_card(statement["card"], card["value"])
+    items = statement["items"]
+    next_url = statement["next_url"]
+    while next_url:
+        print(f"カード{card['index']}の明細の続きのページへ移動: {next_url}")
+        with span("statement_page_load", card=card["index"]):
+            driver.get(next_url)
+            payload = wait_for_statement(driver, "statement")
+        with span("parse", card=card["index"]):
+            page = from_extracted(payload)
+        check_selected_card(page["card"], card["value"])
+        items.extend(page["items"])
+        next_url = page["next_url"]
+
+    print(f"カード{card['index']} ({card['label']}): {statement['total']}円 (明細{len(items)}件)")
+    return {
+        "card": card["index"],
+        "value": card["value"],
+        "label": card["label"],
+        "amount": statement["total"],
+        "payment_date": statement["payment_date"],
+        "items": items,
+    }
+
+
+def _open_tab(driver, card_detail_url):
+    """新しいタブを開き、通信のブロックを設定してから明細ページの読み込みを始める。タブのハンドルを返す"""
+    handles_before = set(driver.window_handles)
+    driver.execute_script("window.open('about:blank', '_blank');")
+    handle = next(h for h in driver.window_handles if h not in handles_before)
+    driver.switch_to.window(handle)
+    # 通信のブロックはタブごとの設定なので、読み込みを始める前に設定する
+    apply_network_profile(driver)
+    driver.execute_script("window.location.href = arguments[0];", card_detail_url)
+    return handle
+
+
+def _switch_card(driver, card):
+    """
+    表示中のタブでカードを切り替える (遷移を待たずに戻る)。
+    最初の金額が描画されてから印をつけないと、後から描画された元のカードの金額を読んでしまう
+    """
+    wait_for_amount(driver, "statement")
+    mark_amount_stale(driver)
+    print(f"タブでカード{card['index']} (value '{card['value']}') に切り替えます。")
+    driver.execute_script(_SWITCH_CARD_SCRIPT, CARD_SELECT_ID, card["value"])
+
+
+def _close_tabs(driver, handles, main_handle):
+    for handle in handles:
+        try:
+            driver.switch_to.window(handle)
+            driver.close()
+        except WebDriverException as e:
+            print(f"タブを閉じられませんでした: {e}")
+    driver.switch_to.window(main_handle)
+
+
+def read_selected_card(driver):
+    """
+    明細ページを表示中のタブで、表示中のカードの明細とカードの一覧を読み取る。
+    戻り値は (カードのリスト, 表示中のカードの明細)。
+    """
+    with span("statement_load", card="selected"):
+        payload = wait_for_statement(driver, "statement")
+    return list_cards(driver), payload
+
+
+def fetch_all_cards_in_tabs(driver, card_detail_url, cards, selected_payload, skip=()):
+    """
+    明細ページを表示中のブラウザで、全カードの明細を別々のタブで同時に取得する。
+    表示中のカードは read_selected_card で読み取った明細を使い、skip のカード番号 (取得済み) は読み取らない。
+    戻り値は (カード番号ごとの結果, カード番号ごとの例外)。1枚が失敗しても他のカードの結果は返す。
+    """
+    main_handle = driver.current_window_handle
+    selected = next((c for c in cards if c["selected"]), cards[0])
+    results = {}
+    errors = {}
+
+    # 他のカードは新しいタブで明細ページを開く (読み込みはタブごとに並行して進む)
+    others = [c for c in cards if c is not selected and c["index"] not in skip]
+    tabs = []
+    try:
+        for card in others:
+            try:
+                tabs.append((card, _open_tab(driver, card_detail_url)))
+            except WebDriverException as e:
+                errors[card["index"]] = e
+
+        # 各タブでカードを切り替える (遷移を待たずに次のタブへ進む)
+        switched = []
+        for card, handle in tabs:
+            try:
+                driver.switch_to.window(handle)
+                _switch_card(driver, card)
+                switched.append((card, handle))
+            except WebDriverException as e:
+                errors[card["index"]] = e
+
+        # 切り替え後の新しい金額が描画されたものから読み取る
+        for card, handle in switched:
+            try:
+                driver.switch_to.window(handle)
+                with span("statement_load", card=card["index"]):
+                    payload = wait_for_statement(driver, "card_switch")
+                results[card["index"]] = _to_result(driver, card, payload)
+            except _CARD_ERRORS as e:
+                errors[card["index"]] = e
+    finally:
+        _close_tabs(driver, [handle for _, handle in tabs], main_handle)
+
+    # 表示中のカードの続きのページは、他のタブの読み取りの後で元のタブで読む
+    if selected["index"] not in skip:
+        try:
+            results[selected["index"]] = _to_result(driver, selected, selected_payload)
+        except _CARD_ERRORS as e:
+            errors[selected["index"]] = e
+
+    for index, error in errors.items():
+        print(f"カード{index}の取得に失敗しました: {type(error).__name__}: {error}")
+    return results, errors
+
+
+def fetch_card_in_tab(driver, card, card_detail_url):
+    """
+    1枚のカードの明細を新しいタブで取得し直す (失敗したカードの再試行用)。
+    ログイン済みのセッションをそのまま使うので、明細ページの読み込み1回分で済む。
+    """
+    main_handle = driver.current_window_handle
+    handle = _open_tab(driver, card_detail_url)
+    try:
+        if card["selected"]:
+            with span("statement_load", card=card["index"], retry=True):
+                payload = wait_for_statement(driver, "statement")
+        else:
+            _switch_card(driver, card)
+            with span("statement_load", card=card["index"], retry=True):
+                payload = wait_for_statement(driver, "card_switch")
+        return _to_result(driver, card, payload)
+    finally:
+        _close_tabs(driver, [handle], main_handle)
+
+
+def iter_statements_in_tabs(driver, pages, cards, max_tabs):
+    """
+    ログイン済みのブラウザで、複数の明細ページ (月) の各カードを別々のタブで同時に読み込む。
+    pages は (キー, URL) のリスト、cards は list_cards で取得したカードのリスト。
+    タブは max_tabs 個ずつ開き、読み取れたものから (キー, カード, 結果または例外) を順に返す。
+    """
+    main_handle = driver.current_window_handle
+    jobs = [(key, url, card) for key, url in pages for card in cards]
+    for start in range(0, len(jobs), max_tabs):
+        tabs = []
+        failed = []
+        try:
+            # このまとまりのタブをすべて開いてから、カードを切り替える (読み込みはタブごとに並行して進む)
+            for key, url, card in jobs[start:start + max_tabs]:
+                try:
+                    tabs.append((key, card, _open_tab(driver, url)))
+                except WebDriverException as e:
+                    failed.append((key, card, e))
+            switched = []
+            for key, card, handle in tabs:
+                try:
+                    driver.switch_to.window(handle)
+                    if not card["selected"]:
+                        _switch_card(driver, card)
+                    switched.append((key, card, handle))
+                except WebDriverException as e:
+                    failed.append((key, card, e))
+            yield from failed
+
+            for key, card, handle in switched:
+                try:
+                    driver.switch_to.window(handle)
+                    with span("statement_load", card=card["index"], page=key):
+                        payload = wait_for_statement(driver, "statement" if card["selected"] else "card_switch")
+                    yield key, card, _to_result(driver, card, payload)
+                except _CARD_ERRORS as e:
+                    yield key, card, e
+        finally:
+            _close_tabs(driver, [handle for _, _, handle in tabs], main_handle)
@@ -0,0 +1,186 @@
+import os
+import gzip
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tracing import span
+
+# バックグラウンドで送信するスレッドの数
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "4"))
+# Slackへの送信のタイムアウト (秒) と再試行の回数
+SLACK_TIMEOUT_SEC = float(os.getenv("SLACK_TIMEOUT_SEC", "5"))
+SLACK_MAX_RETRIES = int(os.getenv("SLACK_MAX_RETRIES", "3"))
+# ハンドラが返る前に送信の完了を待つ上限 (秒)
+DELIVERY_FLUSH_TIMEOUT_SEC = float(os.getenv("DELIVERY_FLUSH_TIMEOUT_SEC", "10"))
+# Lambdaのタイムアウトに対して残しておく余裕 (ミリ秒)
+DELIVERY_SAFETY_MARGIN_MS = 1000
+
+# --- ウォームスタート間で共有するHTTPセッション、S3クライアント、スレッドプール ---
+_http_session = None
+_s3_client = None
+_executor = None
+_lock = threading.Lock()
+_pending = []
+_slack_messages = []
+
+
+def http_session():
+    """コネクションプール付きの共有requests.Sessionを返す"""
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DELIVERY_WORKERS, pool_maxsize=DELIVERY_WORKERS)
+            _http_session.mount("https://", adapter)
+        return _http_session
+
+
+def s3_client():
+    """コネクションプール付きの共有S3クライアントを返す"""
+    global _s3_client
+    with _lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.config import Config
+
+            _s3_client = boto3.client('s3', config=Config(max_pool_connections=DELIVERY_WORKERS, retries={"max_attempts": 3}))
+        return _s3_client
+
+
+def submit(fn, *args, **kwargs):
+    """送信などの処理をバックグラウンドのスレッドプールに投入する (flush で完了を待つ)"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix="delivery")
+        future = _executor.submit(fn, *args, **kwargs)
+        _pending.append(future)
+    return future
+
+
+# --- S3へのアップロード ---
+def _put_object(bucket, key, body, content_type, content_encoding):
+    extra_args = {}
+    if content_type:
+        extra_args["ContentType"] = content_type
+    if content_encoding:
+        extra_args["ContentEncoding"] = content_encoding
+    try:
+        with span("s3_upload", key=key):
+            s3_client().put_object(Bucket=bucket, Key=key, Body=body, **extra_args)
+        print(f"S3://{bucket}/{key} にアップロードしました。({len(body)} bytes)")
+        return True
+    except Exception as e:
+        print(f"S3アップロードエラー: {e}")
+        return False
+
+
+def upload_bytes(bucket, key, data, content_type=None, compress=False):
+    """
+    メモリ上のデータを/tmpに書かずにそのままS3にアップロードする (バックグラウンドで実行)。
+    compress=True ならgzipで圧縮し、ContentEncoding: gzip を付ける。
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    content_encoding = None
+    if compress:
+        data = gzip.compress(data, compresslevel=6)
+        content_encoding = "gzip"
+    return submit(_put_object, bucket, key, data, content_type, content_encoding)
+
+
+def upload_file(file_name, bucket, key, content_type=None):
+    """ローカルのファイルをS3にアップロードする (バックグラウンドで実行)"""
+    with open(file_name, "rb") as f:
+        data = f.read()
+    return submit(_put_object, bucket, key, data, content_type, None)
+
+
+# --- Slackへの通知 ---
+def queue_slack_message(text, on_sent=None):
+    """
+    Slackに送る本文を溜めておく。flush() で1回の実行につき1通にまとめて送る。
+    on_sent は送信に成功したときだけ、送信したスレッドで呼ばれる
+    """
+    with _lock:
+        _slack_messages.append((text, on_sent))
+
+
+def _retry_after(response):
+    """429の応答のRetry-Afterヘッダー (秒) を読む。なければ0"""
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0
+
+
+def _post_slack(webhook_url, text):
+    """Slackに投稿する。429や5xx、通信エラーの場合は指数バックオフで再試行する"""
+    import requests
+
+    for attempt in range(SLACK_MAX_RETRIES + 1):
+        delay = 0.5 * 2 ** attempt
+        try:
+            with span("slack_delivery", attempt=attempt):
+                response = http_session().post(webhook_url, json={"text": text}, timeout=SLACK_TIMEOUT_SEC)
+            if response.ok:
+                print("Slackにメッセージを送信しました。")
+                return True
+            print(f"Slackメッセージの送信に失敗しました: {response.status_code} {response.text}")
+            if response.status_code != 429 and response.status_code < 500:
+                return False
+            delay = max(delay, _retry_after(response))
+        except requests.exceptions.RequestException as e:
+            print(f"Slackメッセージの送信に失敗しました: {e}")
+        if attempt < SLACK_MAX_RETRIES:
+            print(f"{delay:.1f}秒後にSlackへの送信を再試行します。({attempt + 1}/{SLACK_MAX_RETRIES})")
+            time.sleep(delay)
+    print("Slackメッセージの送信を諦めました。")
+    return False
+
+
+def _post_slack_and_confirm(webhook_url, text, callbacks):
+    """Slackに投稿し、成功したら送信後の処理 (通知済みの記録など) を呼ぶ"""
+    if not _post_slack(webhook_url, text):
+        return False
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Slackへの送信後の処理に失敗しました: {e}")
+    return True
+
+
+def flush(webhook_url=None, context=None, timeout=None):
+    """
+    溜めたSlackの本文を1通にまとめて送信し、送信中の処理の完了を期限まで待つ。
+    Lambdaの context があれば残り時間を超えないように待つ。
+    戻り値は期限までに終わらなかった処理の数。
+    """
+    with _lock:
+        messages = list(_slack_messages)
+        _slack_messages.clear()
+    if messages:
+        if webhook_url:
+            callbacks = [on_sent for _, on_sent in messages if on_sent]
+            submit(_post_slack_and_confirm, webhook_url, "\n\n".join(text for text, _ in messages), callbacks)
+        else:
+            print("エラー: SLACK_WEBHOOK_URL が設定されていません。Slack通知をスキップします。")
+
+    timeout = DELIVERY_FLUSH_TIMEOUT_SEC if timeout is None else timeout
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        timeout = min(timeout, max(0, context.get_remaining_time_in_millis() - DELIVERY_SAFETY_MARGIN_MS) / 1000)
+
+    with _lock:
+        pending = list(_pending)
+        _pending.clear()
+    if not pending:
+        return 0
+    _, not_done = wait(pending, timeout=timeout)
+    if not_done:
+        print(f"{len(not_done)}件の送信が {timeout:.1f} 秒以内に完了しませんでした。")
+    return len(not_done)
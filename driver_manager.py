@@ -0,0 +1,250 @@
+import os
+import time
+import shutil
+import threading
+from urllib.parse import urlparse
+
+from selenium.common.exceptions import WebDriverException
+
+from network_profile import apply_network_profile
+from tracing import span
+
+# Dockerfileで設定したChromedriverとChromeバイナリのパス
+CHROME_DRIVER_PATH = os.environ.get("CHROME_DRIVER_PATH", "/opt/chromedriver")
+CHROME_BINARY_PATH = os.environ.get("CHROME_BINARY_PATH", "/opt/chrome/chrome")
+
+# ウォームスタートでドライバを使い回す上限（経過秒数と利用回数）
+DRIVER_MAX_AGE_SEC = int(os.getenv("DRIVER_MAX_AGE_SEC", "1800"))
+DRIVER_MAX_USES = int(os.getenv("DRIVER_MAX_USES", "50"))
+
+# Chromeのプロファイルやキャッシュを置く書き込み可能なディレクトリ
+CHROME_TMP_DIR = os.getenv("CHROME_TMP_DIR", "/tmp")
+# イメージのビルド時に作成しておいたプロファイルとキャッシュ (なければ空の状態から起動する)
+CHROME_PROFILE_TEMPLATE_DIR = os.getenv("CHROME_PROFILE_TEMPLATE_DIR", "/opt/chrome-profile")
+
+# ブラウザを使い回すときにストレージ (localStorageなど) を消去するオリジン (カンマ区切り)。
+# 明細サイトと、ログイン時にリダイレクトされるログイン基盤 (SSO)。TARGET_URL と CARD_DETAIL_URL のオリジンも消去する
+STORAGE_CLEAR_ORIGINS = os.getenv("STORAGE_CLEAR_ORIGINS", "https://www.rakuten-card.co.jp,https://login.account.rakuten.com")
+
+# ブラウザとHTTPクライアントで共通のUser-Agent
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.6422.112 Safari/537.36"
+
+# --- モジュールレベルで保持するドライバ (Lambdaのウォームスタート間で共有される) ---
+_driver = None
+_driver_started_at = None
+_driver_uses = 0
+# このプロセスでまだChromeを起動していないか (初回起動の計測に使う)
+_first_launch = True
+
+
+def _profile_dirs(slot=None):
+    """スロットごとのChromeのディレクトリ (user-data-dir, data-path, disk-cache-dir)"""
+    suffix = f"-{slot}" if slot is not None else ""
+    return {
+        "user-data": os.path.join(CHROME_TMP_DIR, f"user-data{suffix}"),
+        "data-path": os.path.join(CHROME_TMP_DIR, f"data-path{suffix}"),
+        "cache-dir": os.path.join(CHROME_TMP_DIR, f"cache-dir{suffix}"),
+    }
+
+
+def prepare_profile(slot=None):
+    """
+    ビルド時に作成したプロファイルとキャッシュを/tmpにコピーする (コピー済みなら何もしない)。
+    /opt は読み取り専用なのでシンボリックリンクではなくコピーする。
+    """
+    for name, target in _profile_dirs(slot).items():
+        source = os.path.join(CHROME_PROFILE_TEMPLATE_DIR, name)
+        if not os.path.isdir(source) or os.path.exists(target):
+            continue
+        try:
+            shutil.copytree(source, target, symlinks=True)
+        except OSError as e:
+            # コピーが途中で失敗したら、空の状態から起動させる
+            print(f"Chromeのプロファイルのコピーに失敗しました: {e}")
+            shutil.rmtree(target, ignore_errors=True)
+
+
+def _start_profile_copy():
+    """初期化時にプロファイルのコピーをバックグラウンドで始める (HTTPのみの実行を待たせない)"""
+    if not os.path.isdir(CHROME_PROFILE_TEMPLATE_DIR):
+        return None
+    thread = threading.Thread(target=prepare_profile, name="chrome-profile-copy", daemon=True)
+    thread.start()
+    return thread
+
+
+_profile_copy = _start_profile_copy()
+
+
+def build_chrome_options(slot=None):
+    """
+    Lambda上でheadless Chromeを起動するためのオプションを組み立てる。
+    slot を指定すると、同時に起動する他のChromeとプロファイルやキャッシュを分ける。
+    """
+    from selenium import webdriver
+
+    options = webdriver.ChromeOptions()
+    dirs = _profile_dirs(slot)
+
+    # Lambdaで必須のオプション
+    options.add_argument('--headless')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-gpu') # 必須ではないが、推奨
+    options.add_argument('--window-size=1920x1080') # 必須ではないが、推奨
+    options.add_argument('--single-process') # Lambdaでリソース節約
+    options.add_argument('--disable-extensions')
+    options.add_argument('--disable-background-networking')
+    options.add_argument('--disable-default-apps')
+    options.add_argument('--disable-sync')
+    options.add_argument('--disable-translate')
+    options.add_argument('--hide-scrollbars')
+    options.add_argument('--metrics-recording-only')
+    options.add_argument('--mute-audio')
+    options.add_argument('--no-first-run')
+    options.add_argument('--disable-setuid-sandbox') # 重要: no-sandboxと合わせて
+    options.add_argument('--disable-backgrounding-occluded-windows')
+    options.add_argument('--disable-ipc-flooding-protection')
+    options.add_argument('--disable-renderer-backgrounding')
+    options.add_argument('--enable-automation') # ツールによる制御を有効にする
+    options.add_argument('--start-maximized') # ウィンドウサイズを最大化
+    options.add_argument(f'--user-data-dir={dirs["user-data"]}') # ユーザープロファイルを/tmpに
+    options.add_argument(f'--data-path={dirs["data-path"]}') # データパスを/tmpに
+    options.add_argument(f'--disk-cache-dir={dirs["cache-dir"]}') # キャッシュを/tmpに
+    options.add_argument(f"user-agent={USER_AGENT}")
+    # options.binary_location は必ず正しいパスを指定
+    options.binary_location = CHROME_BINARY_PATH # Chromeバイナリのパスを指定
+    # ネットワークアイドルの判定に使うDevToolsのNetworkイベントを取得する
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    return options
+
+
+def launch_driver(slot=None):
+    """
+    新しいChrome/WebDriverを起動する。
+    コールドスタートの内訳として、Seleniumの読み込み、プロファイルの準備、Chromeの起動を別々に記録する。
+    """
+    global _first_launch
+
+    with span("selenium_import", first=_first_launch):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+
+    with span("profile_prepare", slot=slot):
+        if slot is None and _profile_copy is not None:
+            _profile_copy.join()
+        else:
+            prepare_profile(slot)
+
+    service = Service(executable_path=CHROME_DRIVER_PATH)
+    print("WebDriverを起動しています...")
+    with span("chrome_launch", first=_first_launch, slot=slot):
+        driver = webdriver.Chrome(service=service, options=build_chrome_options(slot))
+    _first_launch = False
+    # 暗黙的待機は要素が見つからないたびに待たされるので使わない (明示的待機のみ)
+    driver.implicitly_wait(0)
+    # 画像やフォント、計測用スクリプトなど金額の取得に不要な通信をブロックする
+    apply_network_profile(driver)
+    return driver
+
+
+def is_driver_healthy(driver):
+    """ドライバとブラウザが応答するか確認する"""
+    try:
+        driver.current_window_handle
+        driver.execute_script("return 1")
+        return True
+    except WebDriverException as e:
+        print(f"WebDriverのヘルスチェックに失敗しました: {e}")
+        return False
+
+
+def _storage_origins():
+    """ストレージを消去するオリジンの集合 ('https://www.rakuten-card.co.jp' の形)"""
+    urls = STORAGE_CLEAR_ORIGINS.split(",") + [os.getenv("TARGET_URL") or "", os.getenv("CARD_DETAIL_URL") or ""]
+    origins = set()
+    for url in urls:
+        parsed = urlparse(url.strip())
+        if parsed.scheme and parsed.netloc:
+            origins.add(f"{parsed.scheme}://{parsed.netloc}")
+    return origins
+
+
+def clear_browser_state(driver):
+    """
+    全ドメインのCookieと、明細サイトとログイン基盤のストレージを消去する。
+    delete_all_cookies は表示中のドメインのCookieしか消さず、ログイン基盤 (SSO) 側のCookieが残る。
+    Storage.clearDataForOrigin はワイルドカードを受け付けないので、オリジンごとに消去する
+    """
+    driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+    for origin in sorted(_storage_origins()):
+        try:
+            driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        except WebDriverException as e:
+            # ログインの状態はCookieにあるので、ストレージを消せなくても続ける
+            print(f"ストレージ ({origin}) の消去に失敗しました: {e}")
+
+
+def reset_driver_state(driver):
+    """前回の実行の状態 (Cookie、ストレージ、余分なタブ) を消去する"""
+    handles = driver.window_handles
+    for handle in handles[1:]:
+        driver.switch_to.window(handle)
+        driver.close()
+    driver.switch_to.window(handles[0])
+    driver.get("about:blank")
+    clear_browser_state(driver)
+
+
+def _is_stale():
+    """ドライバが使い回しの上限を超えているか"""
+    if _driver_started_at is None:
+        return True
+    if time.time() - _driver_started_at > DRIVER_MAX_AGE_SEC:
+        return True
+    return _driver_uses >= DRIVER_MAX_USES
+
+
+def get_driver():
+    """
+    ウォームなドライバがあれば状態をリセットして返し、なければ新しく起動する。
+    戻り値は (driver, start_type) で、start_type は 'cold' または 'warm'。
+    """
+    global _driver, _driver_started_at, _driver_uses
+
+    if _driver is not None:
+        if _is_stale():
+            print("WebDriverが使い回しの上限に達したため再起動します。")
+            discard_driver()
+        elif not is_driver_healthy(_driver):
+            print("WebDriverが応答しないため再起動します。")
+            discard_driver()
+        else:
+            try:
+                reset_driver_state(_driver)
+                _driver_uses += 1
+                print(f"ウォームなWebDriverを再利用します。(利用回数: {_driver_uses})")
+                return _driver, "warm"
+            except WebDriverException as e:
+                print(f"WebDriverの状態リセットに失敗したため再起動します: {e}")
+                discard_driver()
+
+    _driver = launch_driver()
+    _driver_started_at = time.time()
+    _driver_uses = 1
+    return _driver, "cold"
+
+
+def discard_driver():
+    """保持しているドライバを終了して破棄する (クラッシュ時や上限到達時)"""
+    global _driver, _driver_started_at, _driver_uses
+
+    if _driver is not None:
+        try:
+            _driver.quit()
+            print("WebDriverを閉じました。")
+        except Exception as e:
+            print(f"WebDriverの終了中にエラーが発生しました: {e}")
+    _driver = None
+    _driver_started_at = None
+    _driver_uses = 0
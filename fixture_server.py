@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import random
+import secrets
+import threading
+from string import Template
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+# 楽天e-NAVIのログイン、ようこそ、明細ページを再現するテンプレートの置き場所。
+# 実サイトで取得したHTMLから個人情報を消したものに差し替えられる
+FIXTURE_DIR = os.getenv("FIXTURE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "enavi"))
+# すべてのリクエストに加える遅延 (ミリ秒) と、そのゆらぎの幅
+FIXTURE_LATENCY_MS = float(os.getenv("FIXTURE_LATENCY_MS", "0"))
+FIXTURE_JITTER_MS = float(os.getenv("FIXTURE_JITTER_MS", "0"))
+# 明細ページで金額をJavaScriptで後から描画するまでの時間 (ミリ秒)。0ならHTMLに含める
+FIXTURE_RENDER_DELAY_MS = int(os.getenv("FIXTURE_RENDER_DELAY_MS", "0"))
+# カードの枚数、1枚あたりの利用明細の件数、1ページに表示する件数
+FIXTURE_CARDS = int(os.getenv("FIXTURE_CARDS", "2"))
+FIXTURE_ITEMS = int(os.getenv("FIXTURE_ITEMS", "30"))
+FIXTURE_PAGE_SIZE = int(os.getenv("FIXTURE_PAGE_SIZE", "50"))
+# ログインに使うIDとパスワード
+FIXTURE_USER_ID = os.getenv("FIXTURE_USER_ID", "bench-user")
+FIXTURE_PASSWORD = os.getenv("FIXTURE_PASSWORD", "bench-pass")
+
+LOGIN_PATH = "/e-navi/members/login"
+WELCOME_PATH = "/e-navi/members/"
+STATEMENT_PATH = "/e-navi/members/statement/index.xhtml"
+SESSION_COOKIE = "fixture_session"
+CARD_SELECT_NAME = "j_idt631:card"
+
+# 静的リソース (通信のブロックが効いているかを確かめるため、実際に配信する)
+_STATIC = {
+    "/static/site.css": ("text/css", b"body { font-family: sans-serif; }\n"),
+    "/static/logo.png": ("image/png", b"\x89PNG\r\n\x1a\n" + b"\x00" * 2048),
+    "/static/banner.jpg": ("image/jpeg", b"\xff\xd8\xff\xe0" + b"\x00" * 16384),
+}
+_SHOPS = ["ラクテンイチバ", "コンビニ", "スーパーマーケット", "ドラッグストア", "電気料金", "携帯電話料金", "書店", "カフェ"]
+
+
+def _template(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding="utf-8") as f:
+        return Template(f.read())
+
+
+def make_cards(count=None, items=None, seed=0):
+    """
+    ダミーのカードと利用明細を作る。seed が同じなら毎回同じ内容になる。
+    戻り値はカードのリストで、各カードは value、label、payment_date、items を持つ。
+    """
+    count = FIXTURE_CARDS if count is None else count
+    items = FIXTURE_ITEMS if items is None else items
+    rng = random.Random(seed)
+    cards = []
+    for index in range(count):
+        rows = [
+            {
+                "date": f"2024/05/{1 + i % 28:02d}",
+                "shop": rng.choice(_SHOPS),
+                "amount": rng.randrange(100, 30000, 10),
+            }
+            for i in range(items)
+        ]
+        cards.append({
+            "value": str(index),
+            "label": f"楽天カード{index + 1} (************{1000 + index})",
+            "payment_date": "2024年06月27日",
+            "items": rows,
+        })
+    return cards
+
+
+def _shift_payment_date(payment_date, months_back):
+    """'2024年06月27日' を months_back か月前のお支払い日にする (tabNo ごとに別の月の明細に見せる)"""
+    year, month, day = int(payment_date[:4]), int(payment_date[5:7]), payment_date[8:10]
+    index = year * 12 + month - 1 - months_back
+    return f"{index // 12}年{index % 12 + 1:02d}月{day}日"
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """e-navi のページを再現するリクエストハンドラ。設定は server の属性から読む"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # --- 共通処理 ---
+    def _delay(self):
+        latency = self.server.latency_ms + random.uniform(0, self.server.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def _send(self, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, location, headers=None):
+        self._send(302, b"", headers={"Location": location, **(headers or {})})
+
+    def _form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items()}
+
+    def _logged_in(self):
+        for part in self.headers.get("Cookie", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == SESSION_COOKIE and value in self.server.sessions:
+                return True
+        return False
+
+    # --- ルーティング ---
+    def do_GET(self):
+        self._delay()
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path in _STATIC:
+            content_type, body = _STATIC[url.path]
+            self._send(200, body, content_type)
+        elif url.path == LOGIN_PATH:
+            self._send(200, _template("login_id.html").substitute())
+        elif url.path == WELCOME_PATH:
+            if not self._logged_in():
+                return self._redirect(LOGIN_PATH)
+            self._send(200, _template("welcome.html").substitute())
+        elif url.path == STATEMENT_PATH:
+            if not self._logged_in():
+                return self._redirect(LOGIN_PATH)
+            self._send_statement(query.get("tabNo", "0"), query.get("card", "0"), int(query.get("page", 1)))
+        else:
+            self._send(404, "Not Found", "text/plain")
+
+    def do_POST(self):
+        self._delay()
+        url = urlparse(self.path)
+        form = self._form()
+        if url.path == "/login/id":
+            self._send(200, _template("login_password.html").substitute(error="", user_id=form.get("user_id", "")))
+        elif url.path == "/login/password":
+            if form.get("user_id") != self.server.user_id or form.get("password_current") != self.server.password:
+                page = _template("login_password.html").substitute(
+                    error="ユーザIDまたはパスワードが正しくありません。", user_id=form.get("user_id", ""),
+                )
+                return self._send(200, page)
+            token = secrets.token_hex(16)
+            self.server.sessions.add(token)
+            self._redirect(WELCOME_PATH, {"Set-Cookie": f"{SESSION_COOKIE}={token}; Path=/; HttpOnly"})
+        elif url.path == STATEMENT_PATH:
+            if not self._logged_in():
+                return self._redirect(LOGIN_PATH)
+            if not form.get("javax.faces.ViewState"):
+                return self._send(400, "ViewState is missing", "text/plain")
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self._send_statement(query.get("tabNo", "0"), form.get(CARD_SELECT_NAME, "0"), 1)
+        else:
+            self._send(404, "Not Found", "text/plain")
+
+    # --- 明細ページ ---
+    def _send_statement(self, tab_no, card_value, page):
+        html = self._render_statement(tab_no, card_value, page)
+        if html is None:
+            # 知らないカードを黙って既定のカードで返さない
+            return self._send(400, f"Unknown card: {card_value}", "text/plain")
+        self._send(200, html)
+
+    def _render_statement(self, tab_no, card_value, page):
+        cards = self.server.cards
+        card = next((c for c in cards if c["value"] == card_value), None)
+        if card is None:
+            return None
+        page_size = self.server.page_size
+        rows = card["items"][(page - 1) * page_size:page * page_size]
+
+        options = "\n".join(
+            f'    <option value="{c["value"]}"{" selected" if c is card else ""}>{c["label"]}</option>'
+            for c in cards
+        )
+        item_template = _template("statement_item.html")
+        item_rows = "".join(item_template.substitute(date=r["date"], shop=r["shop"], amount=f"{r['amount']:,}") for r in rows)
+        pager = ""
+        if page * page_size < len(card["items"]):
+            next_query = urlencode({"tabNo": tab_no, "card": card["value"], "page": page + 1})
+            pager = f'<a class="stmt-pager__next" href="{STATEMENT_PATH}?{next_query}">次へ</a>'
+
+        total = sum(r["amount"] for r in card["items"])
+        amount_html = _template("statement_amount.html").substitute(amount=f"{total:,}").strip()
+        render_delay_ms = self.server.render_delay_ms
+        return _template("statement.html").substitute(
+            tab_no=tab_no,
+            card_options=options,
+            view_state=secrets.token_hex(8),
+            payment_date=_shift_payment_date(card["payment_date"], int(tab_no or 0)),
+            amount_html="" if render_delay_ms > 0 else amount_html,
+            amount_json=json.dumps(amount_html, ensure_ascii=False).replace("</", "<\\/"),
+            render_delay_ms=render_delay_ms,
+            item_rows=item_rows,
+            pager=pager,
+        )
+
+
+def make_server(host="127.0.0.1", port=0, latency_ms=None, jitter_ms=None, render_delay_ms=None,
+                cards=None, page_size=None, user_id=None, password=None, verbose=False):
+    """フィクスチャサーバーを作る (port=0 なら空いているポートを使う)。設定は未指定なら環境変数から読む"""
+    server = ThreadingHTTPServer((host, port), FixtureHandler)
+    server.daemon_threads = True
+    server.latency_ms = FIXTURE_LATENCY_MS if latency_ms is None else latency_ms
+    server.jitter_ms = FIXTURE_JITTER_MS if jitter_ms is None else jitter_ms
+    server.render_delay_ms = FIXTURE_RENDER_DELAY_MS if render_delay_ms is None else render_delay_ms
+    server.cards = cards if cards is not None else make_cards()
+    server.page_size = page_size or FIXTURE_PAGE_SIZE
+    server.user_id = user_id or FIXTURE_USER_ID
+    server.password = password or FIXTURE_PASSWORD
+    server.sessions = set()
+    server.verbose = verbose
+    return server
+
+
+def base_url(server):
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def start_in_background(**kwargs):
+    """フィクスチャサーバーを別スレッドで起動し、(server, ベースURL) を返す。server.shutdown() で止める"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True).start()
+    return server, base_url(server)
+
+
+def site_env(url, server):
+    """main.py をフィクスチャサーバーに向けるための環境変数"""
+    return {
+        "TARGET_URL": f"{url}{LOGIN_PATH}",
+        "CARD_DETAIL_URL": f"{url}{STATEMENT_PATH}?tabNo=0",
+        "ID": server.user_id,
+        "PW": server.password,
+    }
+
+
+if __name__ == "__main__":
+    server = make_server(port=int(os.getenv("FIXTURE_PORT", "8765")), verbose=True)
+    url = base_url(server)
+    print(f"フィクスチャサーバーを起動しました: {url}")
+    for name, value in site_env(url, server).items():
+        print(f"{name}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,445 @@
+import io
+import os
+import re
+import gzip
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import delivery
+from tracing import span
+
+# 履歴 (Parquet) を保存するローカルのディレクトリ
+HISTORY_DIR = os.getenv("HISTORY_DIR", "/tmp/enavi_history")
+# S3に保存する場合のバケット名とキーのプレフィックス (未設定ならローカルのみ)
+HISTORY_BUCKET = os.getenv("HISTORY_BUCKET")
+HISTORY_PREFIX = os.getenv("HISTORY_PREFIX", "history/")
+# 履歴の保存を止める (0で無効)
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "1") == "1"
+# パーティションに追加分のファイルがこの数だけ溜まったら、1つのParquetファイルにまとめる
+HISTORY_COMPACT_AFTER = int(os.getenv("HISTORY_COMPACT_AFTER", "24"))
+# S3から同時に読み込むファイルの数
+HISTORY_READ_WORKERS = int(os.getenv("HISTORY_READ_WORKERS", "8"))
+
+# S3のParquetファイルを範囲指定で読むファイルシステム (ウォームスタート間で共有する)
+_s3_filesystem = None
+_s3_filesystem_lock = threading.Lock()
+
+# データセットごとの列。パーティションの列 (month) はパスに入るのでファイルには含めない。
+# 実行ごとの行はまず追加分 (staged-*.jsonl.gz、pyarrowを使わずに書ける) として保存し、
+# 溜まったら compact でパーティションごとに1つのParquetファイル (part-*.parquet) にまとめる
+# cards: 実行ごとのカードの金額 / items: 明細が変わったときの利用明細 / spans: 実行ごとのフェーズの所要時間
+_SCHEMAS = {
+    "cards": [
+        ("run_id", "string"), ("run_at", "timestamp"), ("account", "string"), ("card", "int32"),
+        ("label", "string"), ("payment_date", "string"), ("amount", "int64"), ("changed", "bool"),
+    ],
+    "items": [
+        ("run_id", "string"), ("run_at", "timestamp"), ("account", "string"), ("card", "int32"),
+        ("date", "string"), ("shop", "string"), ("amount", "int64"),
+    ],
+    "spans": [
+        ("run_id", "string"), ("run_at", "timestamp"), ("start_type", "string"), ("run_status", "string"),
+        ("phase", "string"), ("duration_ms", "float64"), ("status", "string"),
+    ],
+}
+
+
+def _arrow_schema(dataset):
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("ms", tz="UTC"),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in _SCHEMAS[dataset]])
+
+
+def account_key(account):
+    """アカウントの列に入れる値。IDそのものは保存しない"""
+    if not account:
+        return ""
+    return hashlib.sha256(account.encode("utf-8")).hexdigest()[:16]
+
+
+def statement_month(payment_date, fallback=None):
+    """お支払い日 ('2024年06月27日' や '2024/06/27') から明細の月 ('2024-06') を求める"""
+    match = re.search(r"(\d{4})\D+(\d{1,2})", payment_date or "")
+    if match:
+        return f"{match.group(1)}-{int(match.group(2)):02d}"
+    return fallback
+
+
+def _month_of(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m")
+
+
+def _to_millis(timestamp):
+    """追加分のファイルには run_at をUNIX時間のミリ秒で入れる"""
+    return int(timestamp * 1000)
+
+
+# --- 書き込み ---
+def _location(dataset, month, name=""):
+    """パーティション (またはその中のファイル) のローカルのパスと、S3のキー"""
+    relative = f"{dataset}/month={month}/{name}"
+    return os.path.join(HISTORY_DIR, relative), f"{HISTORY_PREFIX}{relative}"
+
+
+def _write_partition(dataset, month, rows, name):
+    """1つのパーティションに1実行分の行を追加分のファイル (gzipしたJSON Lines) として書き出す"""
+    data = gzip.compress("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows).encode("utf-8"))
+    path, key = _location(dataset, month, f"staged-{name}.jsonl.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if HISTORY_BUCKET:
+        delivery.upload_bytes(HISTORY_BUCKET, key, data, content_type="application/x-ndjson")
+
+
+def _write_rows(dataset, rows_by_month, name):
+    for month, rows in rows_by_month.items():
+        if rows:
+            _write_partition(dataset, month, rows, name)
+            # まとめるかどうかの確認 (S3の一覧の取得) とまとめる処理は、実行を待たせないようにバックグラウンドで行う
+            delivery.submit(_compact_if_needed, dataset, month)
+
+
+def append_cards(run_id, card_amounts, changed=None, account=None, run_at=None):
+    """
+    カードごとの金額を履歴に追加する (明細の月でパーティションを分ける)。
+    利用明細は変化のあったカードの分だけ追加する (変化のない実行では前回と同じ内容になるため)。
+    """
+    run_at = run_at or time.time()
+    changed_cards = {c["card"] for c in changed or []}
+    account_hash = account_key(account)
+    timestamp = _to_millis(run_at)
+
+    cards, items = {}, {}
+    for card_amount in card_amounts:
+        # 取得できなかったカードは金額の履歴に残さない (失敗は spans の status で分かる)
+        if card_amount.get("amount") is None:
+            continue
+        month = statement_month(card_amount.get("payment_date"), _month_of(run_at))
+        cards.setdefault(month, []).append({
+            "run_id": run_id,
+            "run_at": timestamp,
+            "account": account_hash,
+            "card": card_amount["card"],
+            "label": card_amount.get("label"),
+            "payment_date": card_amount.get("payment_date"),
+            "amount": card_amount.get("amount"),
+            "changed": card_amount["card"] in changed_cards,
+        })
+        if card_amount["card"] in changed_cards:
+            items.setdefault(month, []).extend(
+                {
+                    "run_id": run_id,
+                    "run_at": timestamp,
+                    "account": account_hash,
+                    "card": card_amount["card"],
+                    "date": item.get("date"),
+                    "shop": item.get("shop"),
+                    "amount": item.get("amount"),
+                }
+                for item in card_amount.get("items") or []
+            )
+    # 複数アカウントを同じ実行で処理する場合に備えて、ファイル名にアカウントを含める
+    name = f"{run_id}-{account_hash}" if account_hash else run_id
+    _write_rows("cards", cards, name)
+    _write_rows("items", items, name)
+
+
+def append_spans(run_id, spans, start_type=None, run_status="ok", run_at=None):
+    """実行中に記録したフェーズごとの所要時間を履歴に追加する (実行した月でパーティションを分ける)"""
+    run_at = run_at or time.time()
+    timestamp = _to_millis(run_at)
+    rows = [
+        {
+            "run_id": run_id,
+            "run_at": timestamp,
+            "start_type": start_type,
+            "run_status": run_status,
+            "phase": span["phase"],
+            "duration_ms": span["duration_ms"],
+            "status": span["status"],
+        }
+        for span in spans
+    ]
+    _write_rows("spans", {_month_of(run_at): rows}, run_id)
+
+
+def append_run(run_id, card_amounts, spans, changed=None, start_type=None, run_status="ok", account=None):
+    """
+    1回の実行の結果 (カードの金額、利用明細、フェーズの所要時間) を履歴に追加する。
+    書き込みに失敗しても、実行そのものは失敗させない。
+    """
+    if not HISTORY_ENABLED:
+        return
+    run_at = time.time()
+    try:
+        if card_amounts:
+            append_cards(run_id, card_amounts, changed, account, run_at)
+        append_spans(run_id, spans, start_type, run_status, run_at)
+    except Exception as e:
+        print(f"履歴の保存に失敗しました: {e}")
+
+
+# --- まとめる処理 ---
+def _list_files(dataset, month):
+    """パーティションにあるファイルの名前の一覧"""
+    path, key = _location(dataset, month)
+    if HISTORY_BUCKET:
+        paginator = delivery.s3_client().get_paginator("list_objects_v2")
+        return sorted(
+            obj["Key"][len(key):]
+            for page in paginator.paginate(Bucket=HISTORY_BUCKET, Prefix=key)
+            for obj in page.get("Contents", [])
+        )
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.listdir(path))
+
+
+def _read_file(dataset, month, name):
+    path, key = _location(dataset, month, name)
+    if HISTORY_BUCKET:
+        return delivery.s3_client().get_object(Bucket=HISTORY_BUCKET, Key=key)["Body"].read()
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _delete_files(dataset, month, names):
+    for name in names:
+        path, _ = _location(dataset, month, name)
+        if os.path.exists(path):
+            os.remove(path)
+    if HISTORY_BUCKET:
+        _, key = _location(dataset, month)
+        for start in range(0, len(names), 1000):
+            delivery.s3_client().delete_objects(
+                Bucket=HISTORY_BUCKET,
+                Delete={"Objects": [{"Key": key + name} for name in names[start:start + 1000]], "Quiet": True},
+            )
+
+
+def _staged_rows(data):
+    """追加分のファイルの行を、Parquetから読んだ行と同じ形にする"""
+    rows = [json.loads(line) for line in gzip.decompress(data).decode("utf-8").splitlines() if line]
+    for row in rows:
+        row["run_at"] = datetime.fromtimestamp(row["run_at"] / 1000, timezone.utc)
+    return rows
+
+
+def compact(dataset, month):
+    """
+    パーティションの追加分と既存のParquetファイルを1つのParquetファイルにまとめ、元のファイルを消す。
+    まとめたファイルの名前は元のファイルの名前から決めるので、2つの実行が同時にまとめても同じファイルになる。
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = [n for n in _list_files(dataset, month) if n.startswith(("staged-", "part-"))]
+    if len(names) < 2:
+        return
+    rows = []
+    for name in names:
+        data = _read_file(dataset, month, name)
+        if name.startswith("staged-"):
+            rows.extend(_staged_rows(data))
+        else:
+            rows.extend(pq.read_table(io.BytesIO(data), schema=_arrow_schema(dataset)).to_pylist())
+
+    table = pa.Table.from_pylist(rows, schema=_arrow_schema(dataset))
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    data = buffer.getvalue()
+
+    name = "part-" + hashlib.sha256(",".join(names).encode("utf-8")).hexdigest()[:16] + ".parquet"
+    path, key = _location(dataset, month, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    if HISTORY_BUCKET:
+        # 元のファイルを消す前に、まとめたファイルのアップロードを終える
+        delivery.s3_client().put_object(Bucket=HISTORY_BUCKET, Key=key, Body=data, ContentType="application/vnd.apache.parquet")
+    _delete_files(dataset, month, [n for n in names if n != name])
+    print(f"履歴 {dataset}/month={month} の{len(names)}個のファイルを1つにまとめました。({len(rows)}行)")
+
+
+def _compact_if_needed(dataset, month):
+    """追加分のファイルが HISTORY_COMPACT_AFTER 個以上溜まっていればまとめる"""
+    try:
+        staged = [n for n in _list_files(dataset, month) if n.startswith("staged-")]
+        if len(staged) >= HISTORY_COMPACT_AFTER:
+            with span("history_compact", dataset=dataset, files=len(staged)):
+                compact(dataset, month)
+    except ImportError as e:
+        print(f"pyarrowがないため履歴をまとめません: {e}")
+    except Exception as e:
+        print(f"履歴をまとめるのに失敗しました: {e}")
+
+
+# --- 読み込み ---
+def _months_between(start, end):
+    """'2024-01' から '2024-03' までの月のリスト"""
+    year, month = map(int, start.split("-"))
+    end_year, end_month = map(int, end.split("-"))
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append(f"{year}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def _list_months(dataset):
+    """データセットにあるパーティション (月) の一覧"""
+    if HISTORY_BUCKET:
+        paginator = delivery.s3_client().get_paginator("list_objects_v2")
+        months = set()
+        for page in paginator.paginate(Bucket=HISTORY_BUCKET, Prefix=f"{HISTORY_PREFIX}{dataset}/", Delimiter="/"):
+            for prefix in page.get("CommonPrefixes", []):
+                months.add(prefix["Prefix"].rstrip("/").rsplit("month=", 1)[-1])
+        return sorted(months)
+    root = os.path.join(HISTORY_DIR, dataset)
+    if not os.path.isdir(root):
+        return []
+    return sorted(name.split("=", 1)[1] for name in os.listdir(root) if name.startswith("month="))
+
+
+_OPERATORS = {
+    "=": lambda a, b: a == b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+}
+
+
+def _filter_rows(rows, columns=None, filters=None):
+    """追加分のファイルの行に、Parquetの読み込みと同じ列の選択と条件をあてはめる"""
+    for row in rows:
+        if all(row.get(column) is not None and _OPERATORS[op](row.get(column), value) for column, op, value in filters or []):
+            yield {c: row.get(c) for c in columns} if columns else row
+
+
+def _parquet_filesystem():
+    """
+    ParquetファイルのS3のファイルシステムを返す。
+    pyarrowがフッターと必要な列・行グループだけを範囲指定のGETで読むので、ファイル全体はダウンロードしない
+    """
+    global _s3_filesystem
+    with _s3_filesystem_lock:
+        if _s3_filesystem is None:
+            from pyarrow import fs
+
+            _s3_filesystem = fs.S3FileSystem(region=delivery.s3_client().meta.region_name)
+        return _s3_filesystem
+
+
+def _read_partition(dataset, month, columns=None, filters=None):
+    """パーティションのすべてのファイル (まとめたParquetと、まだまとめていない追加分) の行を返す"""
+    import pyarrow.parquet as pq
+
+    rows = []
+    for name in _list_files(dataset, month):
+        if name.endswith(".parquet"):
+            path, key = _location(dataset, month, name)
+            if HISTORY_BUCKET:
+                source, filesystem = f"{HISTORY_BUCKET}/{key}", _parquet_filesystem()
+            else:
+                source, filesystem = path, None
+            table = pq.read_table(source, columns=columns, filters=filters, schema=_arrow_schema(dataset), filesystem=filesystem)
+            rows.extend(table.to_pylist())
+        elif name.startswith("staged-"):
+            rows.extend(_filter_rows(_staged_rows(_read_file(dataset, month, name)), columns, filters))
+    return [dict(row, month=month) for row in rows]
+
+
+def read_dataset(dataset, start=None, end=None, columns=None, filters=None):
+    """
+    start から end までの月 ('YYYY-MM') のパーティションだけを読み、行のリストを返す。
+    filters は pyarrow の形式 (例: [("phase", "=", "total")])。各行には month が付く。
+    """
+    months = _list_months(dataset)
+    if start or end:
+        wanted = set(_months_between(start or months[0], end or months[-1])) if months else set()
+        months = [m for m in months if m in wanted]
+    if not months:
+        return []
+
+    # S3ではファイルごとにGETが必要なので、パーティションを並行して読む
+    with ThreadPoolExecutor(max_workers=min(len(months), HISTORY_READ_WORKERS)) as executor:
+        partitions = executor.map(lambda m: _read_partition(dataset, m, columns, filters), months)
+        return [row for rows in partitions for row in rows]
+
+
+def _latest_by_card(rows):
+    """同じ明細の月・アカウント・カードの行のうち、最後に取得したものだけを残す"""
+    latest = {}
+    for row in sorted(rows, key=lambda r: r["run_at"]):
+        if row["amount"] is not None:
+            latest[(row["month"], row["account"], row["card"])] = row
+    return latest
+
+
+def monthly_totals(start=None, end=None, account=None):
+    """
+    明細の月ごとの合計金額と前月比を返す。
+    戻り値の例: [{"month": "2024-06", "total": 123456, "change": 2345, "cards": {1: 100000, 2: 23456}}, ...]
+    """
+    filters = [("account", "=", account_key(account))] if account else None
+    latest = _latest_by_card(read_dataset("cards", start, end, ["run_at", "account", "card", "amount"], filters))
+
+    totals = {}
+    for (month, _, card), row in latest.items():
+        entry = totals.setdefault(month, {"month": month, "total": 0, "cards": {}})
+        entry["total"] += row["amount"]
+        entry["cards"][card] = entry["cards"].get(card, 0) + row["amount"]
+
+    result = []
+    previous = None
+    for month in sorted(totals):
+        entry = totals[month]
+        entry["change"] = entry["total"] - previous["total"] if previous else None
+        result.append(entry)
+        previous = entry
+    return result
+
+
+def card_trend(card, start=None, end=None, account=None):
+    """1枚のカードの明細の月ごとの金額を返す。戻り値の例: [{"month": "2024-06", "amount": 100000, "label": ...}, ...]"""
+    filters = [("card", "=", card)]
+    if account:
+        filters.append(("account", "=", account_key(account)))
+    latest = _latest_by_card(read_dataset("cards", start, end, ["run_at", "account", "card", "label", "amount"], filters))
+    return [
+        {"month": month, "amount": row["amount"], "label": row["label"]}
+        for (month, _, _), row in sorted(latest.items())
+    ]
+
+
+def run_latency_history(phase="total", start=None, end=None):
+    """
+    フェーズの所要時間を実行ごとに古い順で返す (スクレイパーの性能の劣化を見つけるため)。
+    戻り値の例: [{"run_at": ..., "run_id": ..., "start_type": "warm", "duration_ms": 8123.4, "status": "ok"}, ...]
+    """
+    rows = read_dataset(
+        "spans", start, end,
+        ["run_id", "run_at", "start_type", "phase", "duration_ms", "status"],
+        [("phase", "=", phase)],
+    )
+    return [
+        {k: row[k] for k in ("run_at", "run_id", "start_type", "duration_ms", "status")}
+        for row in sorted(rows, key=lambda r: r["run_at"])
+    ]
@@ -0,0 +1,209 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from driver_manager import USER_AGENT
+from statement import CARD_SELECT_ID, LOGIN_FORM_ID, check_selected_card, parse_statement_html
+
+HTTP_TIMEOUT_SEC = float(os.getenv("HTTP_TIMEOUT_SEC", "15"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+# カード切り替えのフォームを探すときに一度に解析するHTMLの大きさ (文字数)
+_FORM_CHUNK_SIZE = 16 * 1024
+
+
+class SessionExpiredError(Exception):
+    """HTTPでの取得中にログインページへリダイレクトされた"""
+
+
+def cookies_from_driver(driver):
+    """ブラウザの全ドメインのCookieを取得する (ログイン基盤側のCookieも含む)"""
+    return driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+
+
+def build_http_session(cookies):
+    """Cookieを引き継いだコネクションプール付きのrequests.Sessionを作る"""
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504), allowed_methods=("GET",))
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "User-Agent": USER_AGENT,
+        "Accept-Language": "ja,en;q=0.8",
+    })
+    for cookie in cookies:
+        session.cookies.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie.get("domain"),
+            path=cookie.get("path", "/"),
+            secure=cookie.get("secure", False),
+        )
+    return session
+
+
+def _check_logged_in(response):
+    """ログインページへリダイレクトされていれば SessionExpiredError を送出する"""
+    response.raise_for_status()
+    if "login" in response.url.lower() or f'id="{LOGIN_FORM_ID}"' in response.text:
+        raise SessionExpiredError(f"ログインページへリダイレクトされました: {response.url}")
+    return response
+
+
+def fetch_statement(session, url):
+    """明細ページのHTMLをHTTPで直接取得する"""
+    print(f"カード明細ページをHTTPで取得: {url}")
+    response = _check_logged_in(session.get(url, timeout=HTTP_TIMEOUT_SEC))
+    return response.text
+
+
+def _read_card_form(html):
+    """
+    明細ページのHTMLをlxmlで先頭から読み、(カード切り替えの <select> を含む <form>, その <select>) を返す。
+    フォームはページの先頭にあるので、読み終えたところで解析をやめる (利用明細の行は読まない)。
+    見つからない要素はNone。
+    """
+    parser = etree.HTMLPullParser(events=("end",))
+    select = form = None
+    for start in range(0, max(len(html), 1), _FORM_CHUNK_SIZE):
+        parser.feed(html[start:start + _FORM_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            if element.tag == "select" and element.get("id") == CARD_SELECT_ID:
+                select = element
+                form = next(select.iterancestors("form"), None)
+            elif form is not None and element == form:
+                return form, select
+    parser.close()
+    return form, select
+
+
+def build_card_switch_form(html, page_url, card_value):
+    """
+    明細ページのHTMLからカード切り替えのJSFフォームを読み取り、
+    (送信先URL, 送信データ) を返す。select_by_value(card_value) に相当する。
+    """
+    form, select = _read_card_form(html)
+    if select is None:
+        raise ValueError(f"カード切り替えドロップダウン ({CARD_SELECT_ID}) が見つかりません。")
+    if form is None:
+        raise ValueError("カード切り替えのフォームが見つかりません。")
+
+    data = {}
+    for field in form.iter("input"):
+        name = field.get('name')
+        if not name or field.get('type') in ('submit', 'button', 'image', 'checkbox', 'radio'):
+            continue
+        data[name] = field.get('value', '')
+    # javax.faces.ViewState などのhiddenはそのまま、カードの選択値だけ差し替える
+    data[select.get('name', CARD_SELECT_ID)] = card_value
+
+    action = urljoin(page_url, form.get('action') or page_url)
+    return action, data
+
+
+def fetch_card_statement(session, html, page_url, card_value):
+    """カード切り替えのフォームをPOSTし、切り替え後の明細ページのHTMLを返す"""
+    action, data = build_card_switch_form(html, page_url, card_value)
+    print(f"カード切り替えをHTTPで送信: value '{card_value}' -> {action}")
+    response = _check_logged_in(session.post(action, data=data, timeout=HTTP_TIMEOUT_SEC, headers={"Referer": page_url}))
+    check_selected_card(_selected_card_value(response.text), card_value)
+    return response.text
+
+
+def _selected_card_value(html):
+    """明細ページのHTMLのカード切り替えドロップダウンで選択中のカードの値"""
+    return next(c["value"] for c in list_cards_from_html(html) if c["selected"])
+
+
+def list_cards_from_html(html):
+    """明細ページのHTMLのカード切り替えドロップダウンから全カードの一覧を取得する"""
+    _, select = _read_card_form(html)
+    if select is None:
+        cards = [{"value": None, "label": "カード1", "selected": True}]
+    else:
+        cards = [
+            {"value": o.get('value'), "label": "".join(o.itertext()).strip(), "selected": o.get('selected') is not None}
+            for o in select.iter('option')
+        ]
+        if not any(c["selected"] for c in cards):
+            cards[0]["selected"] = True
+    for index, card in enumerate(cards, start=1):
+        card["index"] = index
+    return cards
+
+
+def fetch_all_card_statements(session, url):
+    """
+    全カードの明細ページのHTMLを取得する。表示中以外のカードの切り替えPOSTは並行して送る。
+    戻り値はドロップダウンの順に並んだ (カード, HTML) のリスト。
+    """
+    html = fetch_statement(session, url)
+    cards = list_cards_from_html(html)
+    print(f"カードが{len(cards)}枚見つかりました: {[c['label'] for c in cards]}")
+
+    others = [c for c in cards if not c["selected"]]
+    htmls = {c["index"]: html for c in cards if c["selected"]}
+    if others:
+        with ThreadPoolExecutor(max_workers=min(len(others), HTTP_POOL_SIZE)) as executor:
+            futures = {c["index"]: executor.submit(fetch_card_statement, session, html, url, c["value"]) for c in others}
+            for index, future in futures.items():
+                htmls[index] = future.result()
+    return [(card, htmls[card["index"]]) for card in cards]
+
+
+def fetch_statement_with_pages(session, html, page_url, card_value):
+    """
+    明細ページのHTMLを解析し、複数ページに分かれている場合は続きのページも取得して
+    利用明細をまとめた結果を返す。続きのページが card_value 以外のカードを表示していれば CardMismatchError を送出する。
+    """
+    statement = parse_statement_html(html)
+    next_url = statement["next_url"]
+    while next_url:
+        page_url = urljoin(page_url, next_url)
+        page_html = fetch_statement(session, page_url)
+        check_selected_card(_selected_card_value(page_html), card_value)
+        page = parse_statement_html(page_html)
+        statement["items"].extend(page["items"])
+        next_url = page["next_url"]
+    statement["next_url"] = None
+    return statement
+
+
+def iter_statements(session, pages, card_indexes=None):
+    """
+    複数の明細ページ (月) の全カードの明細をコネクションプールで同時に取得し、取得できたものから返す。
+    pages は (キー, URL) のリスト。ページを取得したら、そのページのカード切り替えのPOSTをすぐに送る。
+    (キー, カード, 明細または例外) を返す。ページ自体の取得に失敗した場合はカードがNoneになる。
+    """
+    def load_page(url):
+        html = fetch_statement(session, url)
+        return html, list_cards_from_html(html)
+
+    def load_card(url, html, card):
+        if not card["selected"]:
+            html = fetch_card_statement(session, html, url, card["value"])
+        return fetch_statement_with_pages(session, html, url, card["value"])
+
+    with ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE) as executor:
+        pending = {executor.submit(load_page, url): (key, url, None) for key, url in pages}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                key, url, card = pending.pop(future)
+                try:
+                    result = future.result()
+                except (requests.exceptions.RequestException, SessionExpiredError, ValueError) as e:
+                    yield key, card, e
+                    continue
+                if card is not None:
+                    yield key, card, result
+                    continue
+                html, cards = result
+                for card in cards:
+                    if card_indexes is None or card["index"] in card_indexes:
+                        pending[executor.submit(load_card, url, html, card)] = (key, url, card)
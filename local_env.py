@@ -0,0 +1,8 @@
+import os
+
+# --- 環境変数のロード (ローカルテスト用、Lambdaでは環境変数から直接取得) ---
+# 各モジュールは読み込み時に環境変数から設定を読むため、実行の入り口でほかのモジュールより先にimportする
+if not os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    from dotenv import load_dotenv
+
+    load_dotenv()
@@ -1,20 +1,25 @@
 import os
 import time
-import requests
-from dotenv import load_dotenv
-
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
-from bs4 import BeautifulSoup
-import boto3
+# モジュールの読み込みにかかる時間を測る (コールドスタートの内訳として記録する)
+_import_started = time.perf_counter()
+
+# .env の値を、設定を読み込み時に決めるモジュールより先に反映する
+import local_env  # noqa: F401
+
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
-# --- 環境変数のロード (ローカルテスト用、Lambdaでは環境変数から直接取得) ---
-load_dotenv()
+import delivery
+from driver_manager import get_driver, discard_driver
+from session_cache import restore_session, save_session, load_session, clear_session
+from card_tabs import read_selected_card, fetch_all_cards_in_tabs, fetch_card_in_tab
+from readiness import wait_for, wait_for_text
+from tracing import start_run, span, record, print_summary, run_spans
+from network_profile import collect_network_stats
+from state_store import update_states, mark_notified
+from steps import Checkpoint, StepFailed, run_step, step_retries
+from history_store import append_run
+import scheduler
 
 # Lambdaの環境変数、またはローカルの.envから取得
 TARGET_URL = os.getenv("TARGET_URL", "https://www.rakuten-card.co.jp/e-navi/members/?l-id=corp_oo_top_to_loginenavi")
@@ -27,172 +32,83 @@ SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
 SCREENSHOT_BUCKET = os.getenv("SCREENSHOT_BUCKET") # スクリーンショット保存用のS3バケット名
 # HTMLソースを保存するためのS3バケット名（スクリーンショットと同じでも良い）
 HTML_SOURCE_BUCKET = os.getenv("HTML_SOURCE_BUCKET", SCREENSHOT_BUCKET)
+# 明細の取得方法: browser (従来どおりブラウザで取得) / http (ブラウザはログインだけに使う)
+FETCH_MODE = os.getenv("FETCH_MODE", "browser")
+# ブラウザを起動する前に、保存済みのセッションでHTTPだけで明細を確認する (0で無効)
+PRECHECK_WITHOUT_BROWSER = os.getenv("PRECHECK_WITHOUT_BROWSER", "1") == "1"
+# 明細に変化がない場合はSlackに通知しない (0で毎回通知する)
+NOTIFY_ONLY_ON_CHANGE = os.getenv("NOTIFY_ONLY_ON_CHANGE", "1") == "1"
+
+# モジュールの読み込み時間 (Seleniumのwebdriverやrequestsなど重い依存は使うときに読み込むので含まれない)
+IMPORT_DURATION_MS = (time.perf_counter() - _import_started) * 1000
+_import_recorded = False
 
 # --- デバッグ用：S3にファイルをアップロードするヘルパー関数 ---
 def upload_file_to_s3(file_name, bucket, object_name=None, content_type=None):
-    """S3にファイルをアップロードする"""
+    """S3にファイルをアップロードする (共有クライアントでバックグラウンドに実行)"""
     if object_name is None:
         object_name = os.path.basename(file_name)
+    return delivery.upload_file(file_name, bucket, object_name, content_type=content_type)
 
-    s3_client = boto3.client('s3')
-    try:
-        extra_args = {}
-        if content_type:
-            extra_args['ContentType'] = content_type
-
-        s3_client.upload_file(file_name, bucket, object_name, ExtraArgs=extra_args)
-        print(f"ファイル {file_name} を S3://{bucket}/{object_name} にアップロードしました。")
-        return True
-    except Exception as e:
-        print(f"S3アップロードエラー: {e}")
-        return False
-    
-# --- デバッグ用：現在のHTMLソースをファイルに保存し、S3にアップロードする関数 ---
+# --- デバッグ用：現在のHTMLソースをS3にアップロードする関数 ---
 def save_html_and_upload(driver, bucket, request_id, step_name):
-    """現在のHTMLソースを取得し、/tmpに保存してS3にアップロードする"""
-    html_content = driver.page_source
-    file_path = f"/tmp/{step_name}.html"
+    """現在のHTMLソースを取得し、/tmpに書かずにgzipで圧縮してS3にアップロードする"""
     object_key = f"{request_id}/{step_name}.html"
-
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(html_content)
-        print(f"HTMLソースを {file_path} に保存しました。")
-        upload_file_to_s3(file_path, bucket, object_key, content_type='text/html')
+        html_content = driver.page_source
+        delivery.upload_bytes(bucket, object_key, html_content, content_type='text/html; charset=utf-8', compress=True)
         return f"s3://{bucket}/{object_key}"
     except Exception as e:
-        print(f"HTMLソースの保存またはS3アップロードエラー: {e}")
+        print(f"HTMLソースの取得またはS3アップロードエラー: {e}")
         return None
 
 # --- Slackメッセージ送信関数 ---
-def send_slack_message(card1_money_amount, card2_money_amount):
-    if not SLACK_WEBHOOK_URL:
-        print("エラー: SLACK_WEBHOOK_URL が設定されていません。Slack通知をスキップします。")
-        return
-
-    message_text = (
-        f"カード1: {card1_money_amount}円\n"
-        f"カード2: {card2_money_amount}円\n"
-        f"合計: {card1_money_amount + card2_money_amount}円"
-    )
-
-    payload = {
-        "text": message_text
-    }
-    try:
-        response = requests.post(SLACK_WEBHOOK_URL, json=payload)
-        response.raise_for_status()
-        print("Slackにメッセージを送信しました。")
-    except requests.exceptions.RequestException as e:
-        print(f"Slackメッセージの送信に失敗しました: {e}")
-        if 'response' in locals():
-            print(f"Slackレスポンス: {response.text}")
-
-# --- 金額取得関数 ---
-def get_money_amount(driver, card_detail_url, context): # URLを引数に追加
-    #カード明細ページへ
-    print(f"カード明細ページへ移動: {card_detail_url}")
-    driver.get(card_detail_url)
-
-    # 金額表示の親要素を特定するまで待機
-    print("金額表示のdiv要素を待機中...")
-
-    #デバッグ用
-    #screenshot_path = "/tmp/06_before_final_wait.png"
-    #driver.save_screenshot(screenshot_path)
-    #upload_file_to_s3(screenshot_path, SCREENSHOT_BUCKET, f"{context.aws_request_id}/06_before_final_wait.png")
-    #html_log_urls['06_before_final_wait'] = save_html_and_upload(driver, HTML_SOURCE_BUCKET, context.aws_request_id, "06_before_final_wait")
-    parent_div = WebDriverWait(driver, 30).until( # タイムアウトを長めに
-        EC.presence_of_element_located((By.CLASS_NAME, "stmt-about-payment__money__main__num"))
-    )
-    print("金額表示のdiv要素が見つかりました。")
-
-    div_html_content = parent_div.get_attribute('outerHTML')
-    soup = BeautifulSoup(div_html_content, 'html.parser')
-    money_span = soup.find('span', class_='stmt-u-font-roboto')
-
-    if money_span:
-        amount_text = money_span.get_text(strip=True)
-        print(f"抽出された金額テキスト: {amount_text}")
-
-        try:
-            numeric_amount = int(amount_text.replace(',', ''))
-            print(f"数値として変換された金額: {numeric_amount}")
-            return numeric_amount
-        except ValueError:
-            print(f"エラー: 金額を数値に変換できませんでした: '{amount_text}'")
-            return None
+def format_card_amounts(card_amounts):
+    """カードごとの金額のリストからSlackに送る本文を組み立てる"""
+    lines = []
+    total = 0
+    for result in card_amounts:
+        amount = result["amount"]
+        if amount is None:
+            lines.append(f"カード{result['card']} ({result['label']}): 取得失敗")
+        else:
+            lines.append(f"カード{result['card']} ({result['label']}): {amount:,}円")
+            total += amount
+    if any(result["amount"] is None for result in card_amounts):
+        lines.append(f"合計: {total:,}円 (取得できたカードのみ)")
     else:
-        print("エラー: 指定されたspanタグが見つかりませんでした。")
-        return None
+        lines.append(f"合計: {total:,}円")
+    return "\n".join(lines)
 
-# --- メインのWebサイト操作関数 (Lambdaのハンドラとして動作) ---
-def handler(event, context):
-    driver = None # 初期化
-    card1_money_amount = None
-    card2_money_amount = None
+def send_slack_message(message_text, on_sent=None):
+    """Slackに送る本文を溜めておく。ハンドラの最後に1通にまとめて送信される (成功したら on_sent を呼ぶ)"""
+    delivery.queue_slack_message(message_text, on_sent)
 
-    try:
-        # Dockerfileで設定したChromedriverとChromeバイナリのパス
-        # 環境変数から取得
-        chrome_driver_path = os.environ.get("CHROME_DRIVER_PATH", "/opt/chromedriver")
-        chrome_binary_path = os.environ.get("CHROME_BINARY_PATH", "/opt/chrome/chrome")
-
-        service = Service(executable_path=chrome_driver_path)
-        options = webdriver.ChromeOptions()
-
-
-
-        # Lambdaで必須のオプション
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument('--disable-gpu') # 必須ではないが、推奨
-        options.add_argument('--window-size=1920x1080') # 必須ではないが、推奨
-        options.add_argument('--single-process') # Lambdaでリソース節約
-        options.add_argument('--disable-extensions')
-        options.add_argument('--disable-background-networking')
-        options.add_argument('--disable-default-apps')
-        options.add_argument('--disable-sync')
-        options.add_argument('--disable-translate')
-        options.add_argument('--hide-scrollbars')
-        options.add_argument('--metrics-recording-only')
-        options.add_argument('--mute-audio')
-        options.add_argument('--no-first-run')
-        # 以下を追加してみる
-        options.add_argument('--disable-setuid-sandbox') # 重要: no-sandboxと合わせて
-        options.add_argument('--disable-backgrounding-occluded-windows')
-        options.add_argument('--disable-ipc-flooding-protection')
-        options.add_argument('--disable-renderer-backgrounding')
-        options.add_argument('--enable-automation') # ツールによる制御を有効にする
-        options.add_argument('--start-maximized') # ウィンドウサイズを最大化
-        options.add_argument('--user-data-dir=/tmp/user-data') # ユーザープロファイルを/tmpに
-        options.add_argument('--data-path=/tmp/data-path') # データパスを/tmpに
-        options.add_argument('--disk-cache-dir=/tmp/cache-dir') # キャッシュを/tmpに
-        options.add_argument(f"user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.6422.112 Safari/537.36")
-        # options.binary_location は必ず正しいパスを指定
-        options.binary_location = chrome_binary_path # Chromeバイナリのパスを指定
-
-        # WebDriverの起動
-        print("WebDriverを起動しています...")
-        driver = webdriver.Chrome(service=service, options=options)
-        driver.implicitly_wait(10) # 暗黙的待機 (明示的待機を優先)
+# --- ログイン処理関数 ---
+def login(driver, user_id, password):
+    """ログインページからIDとパスワードを入力して送信する (ログイン後のページは wait_for_welcome で待つ)"""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
 
+    with span("login_page_load"):
         # ログインページへアクセス
         print(f"ログインページへアクセス: {TARGET_URL}")
         driver.get(TARGET_URL)
 
-        # ID 'user_id' のinput要素にユーザーIDを入力
+        # ID 'user_id' のinput要素を待機
         print("ユーザーID入力欄を待機中...")
-        idForm = WebDriverWait(driver, 30).until( # タイムアウトを長めに
+        idForm = wait_for(driver, "login_page").until(
             EC.element_to_be_clickable((By.ID, "user_id"))
         )
-        print(f"ユーザーID入力欄が見つかりました。'{LOGIN_USER_ID}'を入力します。")
-        idForm.send_keys(LOGIN_USER_ID)
+
+    with span("id_submit"):
+        # ID 'user_id' のinput要素にユーザーIDを入力
+        print(f"ユーザーID入力欄が見つかりました。'{user_id}'を入力します。")
+        idForm.send_keys(user_id)
 
         # ログインフォームの「次へ」ボタンをクリック (cta001)
         print("ログインフォームの次へボタン (cta001) を待機中...")
-        parent_div_cta001 = WebDriverWait(driver, 30).until(
+        parent_div_cta001 = wait_for(driver, "id_submit").until(
             EC.element_to_be_clickable((By.ID, "cta001"))
         )
         print("次へボタン (cta001) が見つかりました。クリックします。")
@@ -200,20 +116,29 @@ def handler(event, context):
 
         # パスワード入力欄 (ID: 'password_current')
         print("パスワード入力欄 (password_current) を待機中...")
-        pwForm = WebDriverWait(driver, 30).until(
+        pwForm = wait_for(driver, "id_submit").until(
             EC.visibility_of_element_located((By.ID, "password_current"))
         )
+
+    with span("password_submit"):
         print(f"パスワード入力欄が見つかりました。パスワードを入力します。")
-        pwForm.send_keys(LOGIN_PASSWORD)
+        pwForm.send_keys(password)
 
         # パスワード入力後の「次へ」ボタンをクリック (cta011)
         print("パスワード入力後の次へボタン (cta011) を待機中...")
-        parent_div_cta011 = WebDriverWait(driver, 30).until(
+        parent_div_cta011 = wait_for(driver, "password_submit").until(
             EC.element_to_be_clickable((By.ID, "cta011"))
         )
         print("次へボタン (cta011) が見つかりました。クリックします。")
         parent_div_cta011.find_element(By.XPATH, ".//div[text()='次へ']").click()
 
+# --- ログイン後のページを待つ ---
+def wait_for_welcome(driver):
+    """
+    ログイン後のページ (「ようこそ」) が表示されるまで待つ。
+    この後はすぐに明細ページへ移動し、明細ページは金額の描画を待つので、通信が落ち着くまでは待たない
+    """
+    with span("welcome_wait"):
         # ログイン後のページ読み込みを待つ（金額表示のdivなど）
         print("ログイン後のページ読み込みを待機中...")
         #デバッグ用　スクリーンショットとhtml sourceを取得
@@ -222,76 +147,284 @@ def handler(event, context):
         #upload_file_to_s3(screenshot_path, SCREENSHOT_BUCKET, f"{context.aws_request_id}/06_before_final_wait.png")
         #html_log_urls['06_before_final_wait'] = save_html_and_upload(driver, HTML_SOURCE_BUCKET, context.aws_request_id, "06_before_final_wait")
 
-        WebDriverWait(driver, 60).until(
-            EC.text_to_be_present_in_element((By.TAG_NAME, "body"), "ようこそ")
-        )
+        wait_for_text(driver, "ようこそ", "welcome")
         print("ログイン後のページがロードされました。")
 
-        # --- カード1の金額取得 ---
-        print("カード1の金額を取得します...")
-        time.sleep(5)
-        card1_money_amount = get_money_amount(driver, CARD_DETAIL_URL, context)
-
-        # --- カード切り替え ---
-        # j_idt631:card の <select> 要素を待機
-        print("カード切り替えドロップダウン (j_idt631:card) を待機中...")
-        select_element = WebDriverWait(driver, 30).until(
-            EC.presence_of_element_located((By.ID, "j_idt631:card"))
-        )
-        print("カード切り替えドロップダウンが見つかりました。")
-
-        selector = Select(select_element)
-        print("value '1' のオプションを選択します。")
-        selector.select_by_value("1") # 2枚目のカードを選択
+# --- ブラウザでの金額取得 (全カード) ---
+def _failed_card(card, error):
+    """再試行しても取得できなかったカードの結果 (Slackには「取得失敗」と表示される)"""
+    return {
+        "card": card["index"],
+        "value": card["value"],
+        "label": card["label"],
+        "amount": None,
+        "payment_date": None,
+        "items": [],
+        "error": f"{type(error).__name__}: {error}",
+    }
 
-        # カード切り替え後のページ読み込みを待つ（金額表示のdivなど）
-        print("カード切り替え後のページ読み込みを待機中...")
-        WebDriverWait(driver, 30).until(
-            EC.presence_of_element_located((By.CLASS_NAME, "stmt-about-payment__money__main__num"))
-        )
-        print("カード切り替え後のページがロードされました。")
+def _retry_card(checkpoint, driver, card, error):
+    """
+    並行取得で失敗したカードだけを、ログイン済みのセッションのまま新しいタブで取り直す。
+    再試行の回数を使い切ったら取得失敗の結果を返す (他のカードの結果は捨てない)。
+    """
+    step = f"card:{card['index']}"
+    retries = step_retries(step)
+    if retries <= 0:
+        return _failed_card(card, error)
+    try:
+        # 並行取得を1回目の試行として数える
+        return run_step(checkpoint, step, lambda: fetch_card_in_tab(driver, card, CARD_DETAIL_URL), retries=retries - 1)
+    except StepFailed as e:
+        print(f"カード{card['index']}は再試行しても取得できませんでした: {e}")
+        return _failed_card(card, e.error)
+
+def fetch_cards_in_browser(driver, session_restored, checkpoint):
+    """
+    ブラウザを操作して全カードの金額を別々のタブで同時に取得する。
+    取得済みのカード (チェックポイント) は取り直さず、失敗したカードだけを再試行する。
+    """
+    # セッション復元で既に明細ページを表示している場合は、最初の1回だけ移動しない
+    navigate = {"needed": not session_restored}
+
+    def open_statement():
+        if navigate["needed"]:
+            print(f"カード明細ページへ移動: {CARD_DETAIL_URL}")
+            driver.get(CARD_DETAIL_URL)
+        navigate["needed"] = True
+        return read_selected_card(driver)
+
+    cards, selected_payload = run_step(checkpoint, "statement", open_statement)
+    skip = {c["index"] for c in cards if checkpoint.done(f"card:{c['index']}")}
+    results, errors = fetch_all_cards_in_tabs(driver, CARD_DETAIL_URL, cards, selected_payload, skip)
+    for index, result in results.items():
+        checkpoint.complete(f"card:{index}", result)
+
+    card_amounts = []
+    for card in cards:
+        if card["index"] in errors:
+            card_amounts.append(_retry_card(checkpoint, driver, card, errors[card["index"]]))
+        else:
+            card_amounts.append(checkpoint.get(f"card:{card['index']}"))
+    return card_amounts
+
+# --- HTTPでの金額取得 (ブラウザはログインにだけ使う) ---
+def fetch_cards_over_http(cookies):
+    """ログイン済みのCookieで全カードの明細ページをHTTPで直接取得する"""
+    from http_fetch import build_http_session, fetch_all_card_statements, fetch_statement_with_pages
+
+    session = build_http_session(cookies)
+
+    # select_by_value の代わりにJSFのフォームをPOSTする (カードごとに並行して送る)
+    print("全カードの金額をHTTPで取得します...")
+    with span("statement_load", card="all", mode="http"):
+        statements = fetch_all_card_statements(session, CARD_DETAIL_URL)
+
+    card_amounts = []
+    for card, html in statements:
+        with span("parse", card=card["index"]):
+            statement = fetch_statement_with_pages(session, html, CARD_DETAIL_URL, card["value"])
+        print(f"カード{card['index']} ({card['label']}): {statement['total']}円 (明細{len(statement['items'])}件)")
+        card_amounts.append({
+            "card": card["index"],
+            "value": card["value"],
+            "label": card["label"],
+            "amount": statement["total"],
+            "payment_date": statement["payment_date"],
+            "items": statement["items"],
+        })
+    return card_amounts
+
+def try_fetch_cards_without_browser(account=None):
+    """保存済みのCookieだけで取得を試みる。金額を取得できないカードが1枚でもあればNoneを返す"""
+    import requests
+    from http_fetch import SessionExpiredError
+
+    cookies = load_session(account)
+    if not cookies:
+        return None
+    try:
+        card_amounts = fetch_cards_over_http(cookies)
+        missing = [c["card"] for c in card_amounts if c["amount"] is None]
+        if missing:
+            # ログインページ以外の画面 (メンテナンスや再認証など) が返ることがあるので、セッションは使わずにブラウザで取得する
+            print(f"HTTPではカード{missing}の金額を取得できませんでした。ブラウザで取得します。")
+            clear_session(account)
+            return None
+        print("保存済みのセッションでHTTPのみで取得しました。Chromeは起動しません。")
+        return card_amounts
+    except SessionExpiredError as e:
+        print(f"保存済みのセッションが無効です。ブラウザでログインします: {e}")
+        clear_session(account)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"HTTPでの取得に失敗しました。ブラウザで取得します: {e}")
+    return None
+
+# --- 1アカウント分のログインと金額取得 ---
+def scrape_account(driver, user_id, password, account=None, checkpoint=None):
+    """
+    起動済みのブラウザで1アカウント分のログインと全カードの金額取得を行う。
+    account を指定するとセッションの保存先をアカウントごとに分ける。
+    ログインやカードの取得はステップごとに再試行し、失敗したステップだけをやり直す。
+    """
+    checkpoint = checkpoint or Checkpoint(account)
+
+    # 保存済みのセッションが有効ならログインをスキップして明細ページへ直接移動する
+    with span("session_restore") as attrs:
+        session_restored = restore_session(driver, CARD_DETAIL_URL, account)
+        attrs["restored"] = session_restored
+    if not session_restored:
+        run_step(checkpoint, "login", lambda: login(driver, user_id, password))
+        # ようこそページが遅いだけのことがあるので、ログインはやり直さずに待ち直す
+        run_step(checkpoint, "welcome", lambda: wait_for_welcome(driver))
+        save_session(driver, account)
+
+    if FETCH_MODE == "http":
+        from http_fetch import cookies_from_driver
+
+        # HTTPでの取得は1回が軽いので、全カードをまとめて再試行する
+        return run_step(checkpoint, "cards", lambda: fetch_cards_over_http(cookies_from_driver(driver)), retries=step_retries("card"))
+    return fetch_cards_in_browser(driver, session_restored, checkpoint)
 
-        # --- カード2の金額取得 ---
-        print("カード2の金額を取得します...")
-        card2_money_amount = get_money_amount(driver, CARD_DETAIL_URL, context)
+# --- メインのWebサイト操作関数 (Lambdaのハンドラとして動作) ---
+def handler(event, context):
+    global _import_recorded
+    driver = None # 初期化
+    started_at = time.time()
+    run_id = start_run(getattr(context, "aws_request_id", None))
+    if not _import_recorded:
+        # コールドスタート後の最初の実行でだけ、モジュールの読み込み時間を記録する
+        record("import", IMPORT_DURATION_MS)
+        _import_recorded = True
+    start_type = None
+    failed = True
+    card_amounts = None
+    changed = []
+    if scheduler.SCHEDULER_ENABLED and not (event or {}).get("force"):
+        # 締め日から遠く、しばらく明細が変わっていなければ、今回は確認しない
+        decision = scheduler.decide()
+        if not decision["run"]:
+            print(f"今回の確認をスキップします: {decision['reason']} (間隔: {decision['interval_min']:.0f}分)")
+            return {
+                'statusCode': 200,
+                'runId': run_id,
+                'skipped': True,
+                'nextCheckAt': decision["next_check_at"],
+                'body': f"Skipped: {decision['reason']}"
+            }
+    # 前回の実行が途中で失敗していれば、取得済みのカードの結果を引き継ぐ
+    checkpoint = Checkpoint.load()
 
-        # Slack通知
-        if card1_money_amount is not None and card2_money_amount is not None:
-            send_slack_message(card1_money_amount, card2_money_amount)
-        else:
-            send_slack_message("取得失敗", "取得失敗") # 金額取得が一部でも失敗した場合の通知
+    try:
+        if FETCH_MODE == "http" or PRECHECK_WITHOUT_BROWSER:
+            # 保存済みのセッションが有効ならChromeを起動せずにHTTPだけで取得する
+            # (ほとんどの実行は明細が変わっていないので、ここで終わる)
+            card_amounts = try_fetch_cards_without_browser()
+            if card_amounts is not None:
+                start_type = "http-only"
+
+        if card_amounts is None:
+            # ウォームスタート時は前回のWebDriverを再利用する
+            def launch():
+                with span("driver_launch") as attrs:
+                    launched = get_driver()
+                    attrs["start_type"] = launched[1]
+                return launched
+
+            # 起動に失敗したブラウザは捨ててから起動し直す
+            driver, start_type = run_step(checkpoint, "launch", launch, on_retry=lambda e: discard_driver())
+            print(f"起動種別: {start_type}")
+
+            card_amounts = scrape_account(driver, LOGIN_USER_ID, LOGIN_PASSWORD, checkpoint=checkpoint)
+
+        # ブロックした通信の件数などを記録する
+        network_stats = collect_network_stats(driver) if driver else None
+
+        # 前回の明細と比べ、変化があった場合だけ通知する
+        failed_cards = [r for r in card_amounts if r["amount"] is None]
+
+        def notify():
+            # 前回の実行で通知し損ねた変化も通知する
+            changed, unnotified = update_states(card_amounts)
+            notified = bool(unnotified or failed_cards or not NOTIFY_ONLY_ON_CHANGE)
+            if notified:
+                # Slack通知 (金額取得が一部失敗したカードは「取得失敗」と表示される)
+                # 送信に成功するまでは通知済みとして記録しない
+                send_slack_message(format_card_amounts(card_amounts), on_sent=lambda: mark_notified(unnotified))
+            else:
+                print("前回から明細に変化がないため、Slack通知をスキップします。")
+            return changed, notified
+
+        changed, notified = run_step(checkpoint, "notify", notify)
+        # 取得できなかったカードがあれば、次の実行でそのカードだけを取り直せるようにチェックポイントを残す
+        if not failed_cards:
+            checkpoint.clear()
 
         print("すべての処理が完了しました。")
+        failed = False
         return {
-            'statusCode': 200,
-            'body': f'Scraping completed. Card1: {card1_money_amount}, Card2: {card2_money_amount}'
+            'statusCode': 200 if not failed_cards else 207,
+            'runId': run_id,
+            'startType': start_type,
+            'cards': card_amounts,
+            'network': network_stats,
+            'changedCards': [r["card"] for r in changed],
+            'failedCards': [r["card"] for r in failed_cards],
+            'notified': notified,
+            'body': 'Scraping completed. ' + ', '.join(f"Card{r['card']}: {r['amount']}" for r in card_amounts)
         }
 
+    except StepFailed as e:
+        error_message = f"エラー: {e}"
+        print(error_message)
+        send_slack_message(f"スクレイピング失敗: {e.step} のステップで失敗\n{error_message}")
+        return {
+            'statusCode': 500,
+            'runId': run_id,
+            'startType': start_type,
+            'failedStep': e.step,
+            'body': f'Scraping failed at step {e.step} - {error_message}'
+        }
     except TimeoutException as e:
         error_message = f"エラー: 要素の待機中にタイムアウトしました。{e}"
         print(error_message)
-        send_slack_message("エラー", f"スクレイピング失敗: タイムアウト\n{error_message}")
+        send_slack_message(f"スクレイピング失敗: タイムアウト\n{error_message}")
         return {
             'statusCode': 500,
+            'runId': run_id,
+            'startType': start_type,
             'body': f'Scraping failed: Timeout - {error_message}'
         }
     except NoSuchElementException as e:
         error_message = f"エラー: 必要な要素が見つかりませんでした。{e}"
         print(error_message)
-        send_slack_message("エラー", f"スクレイピング失敗: 要素見つからず\n{error_message}")
+        send_slack_message(f"スクレイピング失敗: 要素見つからず\n{error_message}")
         return {
             'statusCode': 500,
+            'runId': run_id,
+            'startType': start_type,
             'body': f'Scraping failed: No such element - {error_message}'
         }
     except Exception as e:
         error_message = f"予期せぬエラーが発生しました: {e}"
         print(error_message)
-        send_slack_message("エラー", f"スクレイピング中に予期せぬエラー\n{error_message}")
+        send_slack_message(f"スクレイピング中に予期せぬエラー\n{error_message}")
         return {
             'statusCode': 500,
+            'runId': run_id,
+            'startType': start_type,
             'body': f'Scraping failed: Unexpected error - {error_message}'
         }
     finally:
-        if driver:
-            driver.quit()
-            print("WebDriverを閉じました。")
\ No newline at end of file
+        # 失敗した実行のブラウザは状態が不明なので使い回さない
+        if driver and failed:
+            discard_driver()
+        record("total", (time.time() - started_at) * 1000, "error" if failed else "ok", start_type=start_type)
+        # カードの金額、利用明細、フェーズの所要時間を履歴 (Parquet) に追加する
+        append_run(run_id, card_amounts, run_spans(), changed, start_type, "error" if failed else "ok")
+        # Slack通知とS3へのアップロードの完了を、Lambdaの残り時間の範囲で待つ
+        delivery.flush(SLACK_WEBHOOK_URL, context)
+        print(f"実行時間: {time.time() - started_at:.2f}秒 (起動種別: {start_type})")
+        # ローカル実行時はフェーズごとのp50/p95を表示する
+        if not os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+            print_summary()
\ No newline at end of file
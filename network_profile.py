@@ -0,0 +1,117 @@
+import os
+import json
+from fnmatch import fnmatchcase
+
+from selenium.common.exceptions import WebDriverException
+
+# ブロックの強さ: off (ブロックしない) / standard / aggressive (スタイルシートもブロック)
+NETWORK_PROFILE = os.getenv("NETWORK_PROFILE", "standard")
+# プロファイルから外すブロックのパターン (カンマ区切り、* が使える)。URLではなくパターンと照合する。
+# 例: "*.css*" でスタイルシートのブロックを、"*rat.rakuten.co.jp*" でそのドメインのブロックを外す。
+# Network.setBlockedURLs はパターンでしか指定できないので、個別のURLだけを通すことはできない
+NETWORK_UNBLOCK_PATTERNS = [a.strip() for a in os.getenv("NETWORK_UNBLOCK_PATTERNS", "").split(",") if a.strip()]
+# 追加でブロックするURLのパターン (カンマ区切り、* が使える)
+NETWORK_EXTRA_BLOCKLIST = [b.strip() for b in os.getenv("NETWORK_EXTRA_BLOCKLIST", "").split(",") if b.strip()]
+
+
+def _extension_patterns(*extensions):
+    """拡張子ごとに、クエリ文字列の有無の両方に当たるパターンを作る"""
+    return [p for ext in extensions for p in (f"*.{ext}", f"*.{ext}?*")]
+
+
+# 金額を読むのに不要なリソースの種類 (拡張子で判定する)
+_IMAGE_PATTERNS = _extension_patterns("png", "jpg", "jpeg", "gif", "webp", "svg", "ico")
+_FONT_PATTERNS = _extension_patterns("woff", "woff2", "ttf", "otf", "eot")
+_MEDIA_PATTERNS = _extension_patterns("mp4", "webm", "mp3")
+_STYLESHEET_PATTERNS = _extension_patterns("css")
+# 計測・広告用のサードパーティドメイン
+_TRACKER_PATTERNS = [
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*googleadservices.com*",
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*facebook.net*",
+    "*connect.facebook.com*",
+    "*bat.bing.com*",
+    "*criteo.com*",
+    "*criteo.net*",
+    "*ads.yahoo.com*",
+    "*yjtag.yahoo.co.jp*",
+    "*b.yjtag.jp*",
+    "*omtrdc.net*",
+    "*2o7.net*",
+    "*rat.rakuten.co.jp*",
+    "*twitter.com/i/adsct*",
+    "*analytics.twitter.com*",
+]
+
+PROFILES = {
+    "off": [],
+    "standard": _IMAGE_PATTERNS + _FONT_PATTERNS + _MEDIA_PATTERNS + _TRACKER_PATTERNS,
+    "aggressive": _IMAGE_PATTERNS + _FONT_PATTERNS + _MEDIA_PATTERNS + _STYLESHEET_PATTERNS + _TRACKER_PATTERNS,
+}
+
+
+def blocked_url_patterns(profile=None):
+    """プロファイルからブロックするURLのパターンを組み立てる (NETWORK_UNBLOCK_PATTERNS に当たるパターンは除く)"""
+    patterns = PROFILES[profile or NETWORK_PROFILE] + NETWORK_EXTRA_BLOCKLIST
+    return [p for p in patterns if not any(fnmatchcase(p, u) for u in NETWORK_UNBLOCK_PATTERNS)]
+
+
+def apply_network_profile(driver, profile=None):
+    """
+    表示中のタブにCDPのNetwork.setBlockedURLsでブロックするURLを設定する。
+    設定はタブ (ターゲット) ごとなので、新しく開いたタブでも呼び出す必要がある。
+    """
+    patterns = blocked_url_patterns(profile)
+    if not patterns:
+        return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+    except WebDriverException as e:
+        print(f"ブロックするURLの設定に失敗しました: {e}")
+
+
+def _new_stats():
+    return {"requests": 0, "blocked_requests": 0, "blocked_by_type": {}, "transferred_bytes": 0}
+
+
+def read_network_events(driver):
+    """
+    パフォーマンスログからDevToolsのNetworkイベントを読み出し、ブロック数などを集計する。
+    ログは読み出すと消えるため、ネットワークアイドルの判定もこの関数を経由する。
+    """
+    stats = getattr(driver, "network_stats", None)
+    if stats is None:
+        stats = driver.network_stats = _new_stats()
+
+    messages = []
+    for entry in driver.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        method = message.get("method")
+        params = message.get("params", {})
+        if method == "Network.requestWillBeSent":
+            stats["requests"] += 1
+        elif method == "Network.loadingFinished":
+            stats["transferred_bytes"] += int(params.get("encodedDataLength", 0))
+        elif method == "Network.loadingFailed" and params.get("blockedReason"):
+            stats["blocked_requests"] += 1
+            resource_type = params.get("type", "Other")
+            stats["blocked_by_type"][resource_type] = stats["blocked_by_type"].get(resource_type, 0) + 1
+        messages.append(message)
+    return messages
+
+
+def collect_network_stats(driver):
+    """今回の実行で集計したリクエスト数、ブロック数、転送バイト数を返し、集計をリセットする"""
+    try:
+        read_network_events(driver)
+    except WebDriverException as e:
+        print(f"パフォーマンスログの読み出しに失敗しました: {e}")
+    stats = getattr(driver, "network_stats", None) or _new_stats()
+    driver.network_stats = _new_stats()
+    stats["profile"] = NETWORK_PROFILE
+    print(json.dumps({"type": "network", **stats}, ensure_ascii=False))
+    return stats
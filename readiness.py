@@ -0,0 +1,148 @@
+import os
+import time
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from statement import AMOUNT_CLASS_NAME, AMOUNT_SPAN_CLASS_NAME, EXTRACT_STATEMENT_JS
+
+# ステップごとの待機上限 (秒)。STEP_TIMEOUT_<ステップ名> の環境変数で上書きできる
+DEFAULT_STEP_TIMEOUTS = {
+    "login_page": 15,
+    "id_submit": 15,
+    "password_submit": 15,
+    "welcome": 30,
+    "statement": 15,
+    "card_select": 10,
+    "card_switch": 15,
+}
+# WebDriverWaitのポーリング間隔 (デフォルトの0.5秒では遅い)
+POLL_INTERVAL_SEC = 0.1
+
+# 金額表示の要素
+AMOUNT_SELECTOR = f".{AMOUNT_CLASS_NAME}"
+AMOUNT_SPAN_SELECTOR = f".{AMOUNT_SPAN_CLASS_NAME}"
+# 切り替え前の古い金額要素につける印
+STALE_ATTRIBUTE = "data-enavi-stale"
+
+# MutationObserverで要素が描画されるまで待つスクリプト。
+# 古い印のついた要素は無視するので、切り替え前の金額を読むことはない。
+_WAIT_FOR_AMOUNT_SCRIPT = """
+const [selector, spanSelector, staleAttr, done] = arguments;
+const find = () => {
+    const el = document.querySelector(selector);
+    if (!el || el.hasAttribute(staleAttr)) return null;
+    const span = el.querySelector(spanSelector);
+    if (!span || !span.textContent.trim()) return null;
+    return el.outerHTML;
+};
+const found = find();
+if (found) { done(found); return; }
+const observer = new MutationObserver(() => {
+    const html = find();
+    if (html) { observer.disconnect(); done(html); }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+"""
+
+# 金額が描画されたら、同じ呼び出しの中で明細全体を取り出して返すスクリプト
+_WAIT_FOR_STATEMENT_SCRIPT = EXTRACT_STATEMENT_JS + """
+const [selector, spanSelector, staleAttr, done] = arguments;
+const ready = () => {
+    const el = document.querySelector(selector);
+    if (!el || el.hasAttribute(staleAttr)) return false;
+    const span = el.querySelector(spanSelector);
+    return !!(span && span.textContent.trim());
+};
+if (ready()) { done(extractStatement()); return; }
+const observer = new MutationObserver(() => {
+    if (ready()) { observer.disconnect(); done(extractStatement()); }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+"""
+
+_WAIT_FOR_TEXT_SCRIPT = """
+const [text, done] = arguments;
+const check = () => document.body && document.body.innerText.includes(text);
+if (check()) { done(true); return; }
+const observer = new MutationObserver(() => {
+    if (check()) { observer.disconnect(); done(true); }
+});
+observer.observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+"""
+
+
+def step_timeout(step):
+    """ステップの待機上限 (秒) を返す"""
+    value = os.getenv(f"STEP_TIMEOUT_{step.upper()}")
+    if value:
+        return float(value)
+    return DEFAULT_STEP_TIMEOUTS[step]
+
+
+# ページ遷移で古いドキュメントが破棄されたときのエラーメッセージ (小文字)
+_NAVIGATION_ERRORS = (
+    "document unloaded",
+    "execution context was destroyed",
+    "cannot find context with specified id",
+    "inspected target navigated",
+)
+
+
+def wait_for(driver, step):
+    """ステップの待機上限で短い間隔でポーリングするWebDriverWaitを返す"""
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    return WebDriverWait(driver, step_timeout(step), poll_frequency=POLL_INTERVAL_SEC)
+
+
+def _run_observer_script(driver, step, script, *args):
+    """
+    MutationObserverのスクリプトを期限まで実行する。
+    待機中にページ遷移で古いドキュメントが破棄された場合は新しいドキュメントで再実行する。
+    """
+    timeout = step_timeout(step)
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutException(f"ステップ '{step}' が {timeout} 秒以内に完了しませんでした。")
+        driver.set_script_timeout(remaining)
+        try:
+            return driver.execute_async_script(script, *args)
+        except TimeoutException:
+            # スクリプトのタイムアウトもTimeoutExceptionで返る (WebDriverExceptionより先に捕まえる)
+            raise TimeoutException(f"ステップ '{step}' が {timeout} 秒以内に完了しませんでした。")
+        except WebDriverException as e:
+            # "document unloaded while waiting for result" など、遷移中の失敗だけを再試行する。
+            # ブラウザやタブが落ちた場合 (InvalidSessionId、NoSuchWindow など) はすぐに失敗させる
+            if not any(message in str(e).lower() for message in _NAVIGATION_ERRORS):
+                raise
+            if time.monotonic() >= deadline:
+                raise TimeoutException(f"ステップ '{step}' が {timeout} 秒以内に完了しませんでした: {e}")
+            time.sleep(POLL_INTERVAL_SEC)
+
+
+def mark_amount_stale(driver):
+    """カード切り替えの前に、表示中の金額要素に古い印をつける"""
+    driver.execute_script(
+        "const el = document.querySelector(arguments[0]); if (el) el.setAttribute(arguments[1], '1');",
+        AMOUNT_SELECTOR, STALE_ATTRIBUTE,
+    )
+
+
+def wait_for_amount(driver, step="statement"):
+    """金額が描画されるまで待ち、金額のdiv要素のHTMLを返す (古い印のついた要素は無視する)"""
+    return _run_observer_script(driver, step, _WAIT_FOR_AMOUNT_SCRIPT, AMOUNT_SELECTOR, AMOUNT_SPAN_SELECTOR, STALE_ATTRIBUTE)
+
+
+def wait_for_statement(driver, step="statement"):
+    """
+    金額が描画されるまで待ち、そのまま合計金額、お支払い日、利用明細、次ページのURLを取り出して返す。
+    待機と取り出しを1回のWebDriverの呼び出しで行う。
+    """
+    return _run_observer_script(driver, step, _WAIT_FOR_STATEMENT_SCRIPT, AMOUNT_SELECTOR, AMOUNT_SPAN_SELECTOR, STALE_ATTRIBUTE)
+
+
+def wait_for_text(driver, text, step):
+    """ページ本文に text が現れるまで待つ"""
+    return _run_observer_script(driver, step, _WAIT_FOR_TEXT_SCRIPT, text)
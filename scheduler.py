@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import calendar
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import local_env  # noqa: F401  (.env をほかのモジュールより先に読み込む)
+from state_store import load_account_summary
+
+# 固定のスケジュールで起動されても、明細が変わりそうなときだけブラウザを起動する (0で無効)
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0") == "1"
+# 確認の間隔の最短と最長 (分)。明細の変化がない期間が長いほど最長に近づける
+SCHEDULE_MIN_INTERVAL_MIN = float(os.getenv("SCHEDULE_MIN_INTERVAL_MIN", "60"))
+SCHEDULE_MAX_INTERVAL_MIN = float(os.getenv("SCHEDULE_MAX_INTERVAL_MIN", "1440"))
+# 変化がなかった時間のこの割合だけ、次の確認を先に延ばす
+SCHEDULE_BACKOFF_RATIO = float(os.getenv("SCHEDULE_BACKOFF_RATIO", "0.25"))
+# 最後に変化してからこの時間 (時間) は最短の間隔で確認する
+SCHEDULE_RECENT_CHANGE_HOURS = float(os.getenv("SCHEDULE_RECENT_CHANGE_HOURS", "24"))
+# 締め日・明細の確定日・お支払い日の前後この日数は最短の間隔で確認する
+SCHEDULE_NEAR_DAYS = int(os.getenv("SCHEDULE_NEAR_DAYS", "1"))
+# 過去にこの回数以上金額が変わった日 (毎月の日付) も、締め日などと同じように扱う
+SCHEDULE_LEARN_MIN_CHANGES = int(os.getenv("SCHEDULE_LEARN_MIN_CHANGES", "2"))
+# カードごとの請求サイクル (JSON)。例: {"default": {"closing_day": 31}, "2": {"closing_day": 15, "payment_day": 10}}
+# 31 のように月の日数を超える日は月末として扱う
+BILLING_CALENDAR = json.loads(os.getenv("BILLING_CALENDAR") or "{}")
+# 楽天カードの既定: 月末締め、12日ごろに明細が確定、27日払い
+DEFAULT_BILLING_DAYS = {"closing_day": 31, "statement_day": 12, "payment_day": 27}
+# 固定のスケジュールの起動がずれても確認を飛ばさないよう、間隔をこの割合だけ短く見る
+_TOLERANCE_RATIO = 0.05
+# 日付は日本時間で判断する
+JST = timezone(timedelta(hours=9))
+
+
+def _payment_day(payment_date):
+    """お支払い日 ('2024年06月27日' や '2024/06/27') の日"""
+    digits = "".join(ch if ch.isdigit() else " " for ch in payment_date or "").split()
+    return int(digits[2]) if len(digits) >= 3 else None
+
+
+def billing_days(cards=()):
+    """
+    締め日などの、確認を密にする毎月の日の集合を返す。
+    BILLING_CALENDAR の設定に加えて、取得済みの明細のお支払い日も使う。
+    """
+    days = set()
+    default = {**DEFAULT_BILLING_DAYS, **BILLING_CALENDAR.get("default", {})}
+    days.update(default.values())
+    for card in cards:
+        days.update(BILLING_CALENDAR.get(str(card.get("card")), {}).values())
+        payment_day = _payment_day(card.get("payment_date"))
+        if payment_day:
+            days.add(payment_day)
+    return {int(day) for day in days if day}
+
+
+def learned_days(change_history):
+    """過去に SCHEDULE_LEARN_MIN_CHANGES 回以上金額が変わった日 (毎月の日付) の集合を返す"""
+    counts = {}
+    for changed_at in change_history or []:
+        day = datetime.fromtimestamp(changed_at, JST).day
+        counts[day] = counts.get(day, 0) + 1
+    return {day for day, count in counts.items() if count >= SCHEDULE_LEARN_MIN_CHANGES}
+
+
+def _near_day(now, days):
+    """now (日本時間) が、毎月の days のいずれかの前後 SCHEDULE_NEAR_DAYS 日以内なら、その日を返す"""
+    today = datetime.fromtimestamp(now, JST).date()
+    for offset in range(-SCHEDULE_NEAR_DAYS, SCHEDULE_NEAR_DAYS + 1):
+        date = today + timedelta(days=offset)
+        last_day = calendar.monthrange(date.year, date.month)[1]
+        for day in days:
+            if date.day == min(day, last_day):
+                return day
+    return None
+
+
+def next_interval(now, summary):
+    """
+    前回の確認から次の確認までの間隔 (分) と、その理由を返す。
+    締め日などの近くや、最近金額が変わったときは最短の間隔にし、
+    変化のない期間が長くなるほど間隔を延ばす。
+    """
+    if not summary or not summary.get("checked_at"):
+        return 0, "確認の記録がない"
+
+    day = _near_day(now, billing_days(summary.get("cards", [])))
+    if day is not None:
+        return SCHEDULE_MIN_INTERVAL_MIN, f"{day}日 (締め日・確定日・お支払い日) の前後"
+    day = _near_day(now, learned_days(summary.get("change_history")))
+    if day is not None:
+        return SCHEDULE_MIN_INTERVAL_MIN, f"{day}日 (過去に金額がよく変わった日) の前後"
+
+    changed_at = summary.get("changed_at")
+    if changed_at is None:
+        return SCHEDULE_MAX_INTERVAL_MIN, "金額が変わった記録がない"
+    quiet_min = (now - changed_at) / 60
+    if quiet_min <= SCHEDULE_RECENT_CHANGE_HOURS * 60:
+        return SCHEDULE_MIN_INTERVAL_MIN, "最近金額が変わった"
+    interval = min(SCHEDULE_MAX_INTERVAL_MIN, max(SCHEDULE_MIN_INTERVAL_MIN, quiet_min * SCHEDULE_BACKOFF_RATIO))
+    return interval, f"{quiet_min / 60 / 24:.1f}日間変化がない"
+
+
+def decide(now=None, account=None, summary=None):
+    """
+    今回ブラウザを起動して明細を確認するかを決める。
+    戻り値の例: {"run": False, "reason": "...", "interval_min": 360.0, "next_check_at": 1718000000.0}
+    """
+    now = time.time() if now is None else now
+    if summary is None:
+        summary = load_account_summary(account)
+    interval_min, reason = next_interval(now, summary)
+    checked_at = (summary or {}).get("checked_at") or 0
+    next_check_at = checked_at + interval_min * 60
+    run = now >= next_check_at - interval_min * 60 * _TOLERANCE_RATIO
+    return {"run": run, "reason": reason, "interval_min": interval_min, "next_check_at": next_check_at}
+
+
+# --- 固定のスケジュールとの比較 (ドライラン) ---
+def change_times(account=None):
+    """
+    過去に金額が変わった日時を古い順で返す。
+    Parquetの履歴があればそれを使い、なければアカウントのまとめに残っている分を使う。
+    """
+    try:
+        import history_store
+
+        rows = history_store.read_dataset(
+            "cards",
+            columns=["run_at", "account", "changed"],
+            filters=[("changed", "=", True), ("account", "=", history_store.account_key(account))],
+        )
+        if rows:
+            return sorted({row["run_at"].timestamp() for row in rows})
+    except Exception as e:
+        print(f"履歴を読み込めないため、状態に残っている変化の日時を使います: {e}")
+    return sorted((load_account_summary(account) or {}).get("change_history", []))
+
+
+def simulate(changes, start, end, fixed_interval_min=60, cards=()):
+    """
+    start から end まで fixed_interval_min 分ごとに起動される場合に、
+    スケジューラがブラウザを起動する回数と、変化に気づくまでの遅れを再現する。
+    スケジューラは再現の中で気づいた変化だけを学習に使う。
+    """
+    changes = sorted(changes)
+    summary = {"checked_at": None, "changed_at": None, "change_history": [], "cards": list(cards)}
+    fixed_runs = adaptive_runs = 0
+    delays = []
+    pending = 0
+    now = start
+    while now <= end:
+        fixed_runs += 1
+        if decide(now, summary=summary)["run"]:
+            adaptive_runs += 1
+            detected = []
+            while pending < len(changes) and changes[pending] <= now:
+                detected.append(changes[pending])
+                pending += 1
+            if detected:
+                delays.extend((now - changed_at) / 60 for changed_at in detected)
+                summary["changed_at"] = now
+                summary["change_history"].append(now)
+            summary["checked_at"] = now
+        now += fixed_interval_min * 60
+
+    return {
+        "fixed_runs": fixed_runs,
+        "adaptive_runs": adaptive_runs,
+        "saved_runs": fixed_runs - adaptive_runs,
+        "saved_ratio": (fixed_runs - adaptive_runs) / fixed_runs if fixed_runs else 0.0,
+        "changes": len(delays),
+        "mean_delay_min": sum(delays) / len(delays) if delays else None,
+        "max_delay_min": max(delays) if delays else None,
+    }
+
+
+def dry_run(account=None, fixed_interval_min=60, days=None, now=None):
+    """保存済みの変化の日時を使って、固定のスケジュールと比べて削減できる起動の回数を見積もる"""
+    now = time.time() if now is None else now
+    changes = change_times(account)
+    start = now - days * 86400 if days else (changes[0] if changes else now)
+    changes = [c for c in changes if start <= c <= now]
+    cards = (load_account_summary(account) or {}).get("cards", [])
+    result = simulate(changes, start, now, fixed_interval_min, cards)
+    result["start"] = start
+    result["end"] = now
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="固定のスケジュールと比べて削減できるブラウザの起動の回数を見積もる")
+    parser.add_argument("--account", help="アカウントのID (未指定なら main.py のアカウント)")
+    parser.add_argument("--interval-min", type=float, default=60, help="固定のスケジュールの起動の間隔 (分)")
+    parser.add_argument("--days", type=float, help="直近の何日分で見積もるか (未指定なら履歴の最初から)")
+    args = parser.parse_args(argv)
+
+    result = dry_run(args.account, args.interval_min, args.days)
+    start = datetime.fromtimestamp(result["start"], JST).strftime("%Y-%m-%d %H:%M")
+    end = datetime.fromtimestamp(result["end"], JST).strftime("%Y-%m-%d %H:%M")
+    print(f"期間: {start} - {end} (日本時間)")
+    print(f"固定のスケジュール ({args.interval_min:g}分ごと) の起動: {result['fixed_runs']}回")
+    print(f"スケジューラの起動: {result['adaptive_runs']}回 (削減: {result['saved_runs']}回, {result['saved_ratio']:.0%})")
+    if result["changes"]:
+        print(f"金額の変化: {result['changes']}回, 気づくまでの遅れ: 平均 {result['mean_delay_min']:.0f}分 / 最大 {result['max_delay_min']:.0f}分")
+    else:
+        print("期間中に金額の変化の記録がありません。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import hashlib
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+import delivery
+from readiness import wait_for
+from driver_manager import clear_browser_state
+from statement import AMOUNT_CLASS_NAME, LOGIN_FORM_ID
+
+# ログイン済みセッションのCookieを保存する場所
+SESSION_CACHE_PATH = os.getenv("SESSION_CACHE_PATH", "/tmp/enavi_session.json")
+# S3にも保存する場合のバケット名とキー (未設定ならS3は使わない)
+SESSION_CACHE_BUCKET = os.getenv("SESSION_CACHE_BUCKET")
+SESSION_CACHE_KEY = os.getenv("SESSION_CACHE_KEY", "session/enavi_session.json")
+# SSE-KMSで暗号化する場合のKMSキーID (未設定ならS3管理のKMSキー)
+SESSION_CACHE_KMS_KEY_ID = os.getenv("SESSION_CACHE_KMS_KEY_ID")
+
+# Network.setCookiesに渡せるCookieの項目
+_COOKIE_PARAM_KEYS = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires")
+
+
+def _to_cookie_param(cookie):
+    """Network.getAllCookiesの形式のCookieをNetwork.setCookiesの形式に変換する"""
+    param = {k: cookie[k] for k in _COOKIE_PARAM_KEYS if k in cookie}
+    # セッションCookieは expires が -1 になっているので渡さない
+    if param.get("expires", 0) <= 0:
+        param.pop("expires", None)
+    return param
+
+
+def _cache_locations(account=None):
+    """
+    セッションの保存先 (/tmpのパス, S3のキー) を返す。
+    複数アカウントを扱う場合はアカウントごとに分け、IDそのものは名前に含めない。
+    """
+    if not account:
+        return SESSION_CACHE_PATH, SESSION_CACHE_KEY
+    suffix = hashlib.sha256(account.encode("utf-8")).hexdigest()[:16]
+    path_root, path_ext = os.path.splitext(SESSION_CACHE_PATH)
+    key_root, key_ext = os.path.splitext(SESSION_CACHE_KEY)
+    return f"{path_root}_{suffix}{path_ext}", f"{key_root}_{suffix}{key_ext}"
+
+
+def save_session(driver, account=None):
+    """ログイン後のCookieを/tmp (と設定されていればS3) に保存する"""
+    cache_path, cache_key = _cache_locations(account)
+    # get_cookies() は表示中のドメインの分しか返さないため、CDPでログイン基盤側のCookieも含めて取得する
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {})["cookies"]
+    payload = json.dumps({"saved_at": time.time(), "cookies": cookies})
+
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.chmod(cache_path, 0o600)
+        print(f"セッションを {cache_path} に保存しました。")
+    except OSError as e:
+        print(f"セッションの保存に失敗しました: {e}")
+
+    if SESSION_CACHE_BUCKET:
+        extra_args = {"ServerSideEncryption": "aws:kms"}
+        if SESSION_CACHE_KMS_KEY_ID:
+            extra_args["SSEKMSKeyId"] = SESSION_CACHE_KMS_KEY_ID
+        try:
+            delivery.s3_client().put_object(
+                Bucket=SESSION_CACHE_BUCKET,
+                Key=cache_key,
+                Body=payload.encode("utf-8"),
+                ContentType="application/json",
+                **extra_args,
+            )
+            print(f"セッションを S3://{SESSION_CACHE_BUCKET}/{cache_key} に保存しました。")
+        except Exception as e:
+            print(f"セッションのS3保存に失敗しました: {e}")
+
+
+def load_session(account=None):
+    """保存済みのCookieを読み込む。/tmpになければS3から取得する"""
+    cache_path, cache_key = _cache_locations(account)
+    payload = None
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            payload = f.read()
+    elif SESSION_CACHE_BUCKET:
+        try:
+            response = delivery.s3_client().get_object(Bucket=SESSION_CACHE_BUCKET, Key=cache_key)
+            payload = response["Body"].read().decode("utf-8")
+        except Exception as e:
+            print(f"セッションのS3読み込みに失敗しました: {e}")
+
+    if not payload:
+        return None
+
+    try:
+        cookies = json.loads(payload)["cookies"]
+    except (ValueError, KeyError) as e:
+        print(f"保存済みセッションが壊れています: {e}")
+        return None
+
+    # 期限切れのCookieは復元しない
+    now = time.time()
+    return [c for c in cookies if c.get("expires", -1) <= 0 or c["expires"] > now]
+
+
+def clear_session(account=None):
+    """保存済みのセッションを削除する (無効だと分かった場合)"""
+    cache_path, cache_key = _cache_locations(account)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+        print("無効になったセッションを削除しました。")
+    if SESSION_CACHE_BUCKET:
+        # S3に残しておくと、次の読み込みで同じ無効なCookieを取り直してしまう
+        try:
+            delivery.s3_client().delete_object(Bucket=SESSION_CACHE_BUCKET, Key=cache_key)
+            print(f"無効になったセッションを S3://{SESSION_CACHE_BUCKET}/{cache_key} から削除しました。")
+        except Exception as e:
+            print(f"セッションのS3削除に失敗しました: {e}")
+
+
+def restore_session(driver, card_detail_url, account=None):
+    """
+    保存済みのCookieを復元して明細ページへ直接移動する。
+    ログインページへリダイレクトされずに明細が表示されればTrueを返す。
+    """
+    cookies = load_session(account)
+    if not cookies:
+        print("保存済みのセッションがありません。")
+        return False
+
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+
+    try:
+        # CDPで設定すればドメインのページを先に開く必要がない
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": [_to_cookie_param(c) for c in cookies]})
+        print(f"保存済みのCookieを{len(cookies)}件復元しました。")
+
+        print(f"カード明細ページへ直接移動: {card_detail_url}")
+        driver.get(card_detail_url)
+        element = wait_for(driver, "statement").until(EC.any_of(
+            EC.presence_of_element_located((By.CLASS_NAME, AMOUNT_CLASS_NAME)),
+            EC.presence_of_element_located((By.ID, LOGIN_FORM_ID)),
+        ))
+    except (TimeoutException, WebDriverException) as e:
+        print(f"セッションの復元に失敗しました: {e}")
+        return False
+
+    # 先に見つかった要素でどちらのページが表示されたかを判定する
+    if element.get_attribute("id") == LOGIN_FORM_ID or "login" in driver.current_url.lower():
+        print("ログインページへリダイレクトされました。セッションは無効です。")
+        clear_session(account)
+        clear_browser_state(driver)
+        return False
+
+    print("保存済みのセッションで明細ページを表示しました。ログインをスキップします。")
+    return True
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+
+import delivery
+
+# カードごとの前回の状態を保存する場所
+STATE_DIR = os.getenv("STATE_DIR", "/tmp/enavi_state")
+# S3に保存する場合のバケット名とキーのプレフィックス (未設定なら/tmpのみ)
+STATE_BUCKET = os.getenv("STATE_BUCKET")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "state/")
+# 金額が変わった日時を残しておく件数 (請求サイクルの推定に使う)
+MAX_CHANGE_HISTORY = 100
+
+
+def statement_hash(card_amount):
+    """
+    明細の内容 (合計金額、お支払い日、利用明細) のハッシュを返す。
+    HTMLにはViewStateなど毎回変わる値が含まれるため、解析後の内容から計算する。
+    """
+    content = {
+        "amount": card_amount.get("amount"),
+        "payment_date": card_amount.get("payment_date"),
+        "items": [
+            [item.get("date"), item.get("shop"), item.get("amount")]
+            for item in card_amount.get("items") or []
+        ],
+    }
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _state_name(card_amount, account=None):
+    """カード (とアカウント) ごとの状態ファイルの名前。IDやカード名そのものは含めない"""
+    source = f"{account or ''}:{card_amount['card']}:{card_amount.get('label')}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:24] + ".json"
+
+
+def _account_summary_name(account=None):
+    """アカウントごとのまとめ (最後に確認した日時、変化の履歴など) のファイルの名前"""
+    return "account-" + hashlib.sha256(f"{account or ''}".encode("utf-8")).hexdigest()[:24] + ".json"
+
+
+def _load(name):
+    """
+    状態を読み込む。S3を使う場合はS3を正とし、/tmpのコピーはS3を読めなかったときだけ使う
+    (別のコンテナが先に更新していると、/tmpのコピーは古くなっている)
+    """
+    if STATE_BUCKET:
+        try:
+            response = delivery.s3_client().get_object(Bucket=STATE_BUCKET, Key=f"{STATE_PREFIX}{name}")
+            return json.loads(response["Body"].read())
+        except delivery.s3_client().exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            print(f"状態のS3読み込みに失敗しました。/tmpのコピーを使います: {e}")
+    path = os.path.join(STATE_DIR, name)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+
+def _save(name, state):
+    payload = json.dumps(state, ensure_ascii=False)
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, name), "w", encoding="utf-8") as f:
+        f.write(payload)
+    if STATE_BUCKET:
+        try:
+            delivery.s3_client().put_object(
+                Bucket=STATE_BUCKET,
+                Key=f"{STATE_PREFIX}{name}",
+                Body=payload.encode("utf-8"),
+                ContentType="application/json",
+            )
+        except Exception as e:
+            print(f"状態のS3保存に失敗しました: {e}")
+
+
+def load_state(card_amount, account=None):
+    """カードの前回の状態を読み込む。なければNone"""
+    return _load(_state_name(card_amount, account))
+
+
+def save_state(card_amount, state, account=None):
+    """カードの状態を/tmp (と設定されていればS3) に保存する"""
+    _save(_state_name(card_amount, account), state)
+
+
+def load_account_summary(account=None):
+    """
+    アカウントのまとめを読み込む。なければNone。
+    {"checked_at", "changed_at", "change_history", "cards": [{"card", "label", "payment_date"}]}
+    """
+    return _load(_account_summary_name(account))
+
+
+def update_states(card_amounts, account=None):
+    """
+    今回の結果を前回の状態と比べて保存し、(変化のあったカードのリスト, まだ通知していないカードのリスト) を返す。
+    変化を通知し損ねたカードは、mark_notified で記録するまで次の実行でも通知対象として返す。
+    金額を取得できなかったカードは比較も保存もしない。
+    """
+    now = time.time()
+    changed = []
+    unnotified = []
+    for card_amount in card_amounts:
+        if card_amount.get("amount") is None:
+            continue
+        previous = load_state(card_amount, account) or {}
+        content_hash = statement_hash(card_amount)
+        state = {
+            "amount": card_amount["amount"],
+            "payment_date": card_amount.get("payment_date"),
+            "hash": content_hash,
+            "checked_at": now,
+            "changed_at": previous.get("changed_at"),
+            "change_history": previous.get("change_history", []),
+            "notified": previous.get("notified", True),
+        }
+        if previous.get("hash") != content_hash:
+            print(f"カード{card_amount['card']}の明細が変わりました: {previous.get('amount')}円 -> {card_amount['amount']}円")
+            state["changed_at"] = now
+            state["change_history"] = (state["change_history"] + [now])[-MAX_CHANGE_HISTORY:]
+            state["notified"] = False
+            changed.append(card_amount)
+        if not state["notified"]:
+            unnotified.append(card_amount)
+        save_state(card_amount, state, account)
+
+    # スケジューラがアカウント単位で次の確認を決めるためのまとめ
+    summary = load_account_summary(account) or {}
+    history = summary.get("change_history", [])
+    if changed:
+        history = (history + [now])[-MAX_CHANGE_HISTORY:]
+    _save(_account_summary_name(account), {
+        "checked_at": now,
+        "changed_at": now if changed else summary.get("changed_at"),
+        "change_history": history,
+        "cards": [
+            {"card": c["card"], "label": c.get("label"), "payment_date": c.get("payment_date")}
+            for c in card_amounts if c.get("amount") is not None
+        ],
+    })
+    return changed, unnotified
+
+
+def mark_notified(card_amounts, account=None):
+    """カードの変化をSlackに通知できたことを記録する (update_states の後に呼ぶ)"""
+    for card_amount in card_amounts:
+        state = load_state(card_amount, account)
+        if state and not state.get("notified", True):
+            state["notified"] = True
+            save_state(card_amount, state, account)
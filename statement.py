@@ -0,0 +1,173 @@
+from lxml import etree
+
+# カード切り替えの <select> 要素のID (JSFのフォーム内にある)
+CARD_SELECT_ID = "j_idt631:card"
+# ログインページへリダイレクトされたかを判定するための要素のID
+LOGIN_FORM_ID = "user_id"
+# 金額表示の要素
+AMOUNT_CLASS_NAME = "stmt-about-payment__money__main__num"
+AMOUNT_SPAN_CLASS_NAME = "stmt-u-font-roboto"
+# お支払い日の要素
+PAYMENT_DATE_CLASS_NAME = "stmt-about-payment__date"
+# 利用明細の1行と、その中の各項目の要素
+ITEM_ROW_CLASS_NAME = "stmt-payment-lists__i"
+ITEM_DATE_CLASS_NAME = "stmt-payment-lists__date"
+ITEM_SHOP_CLASS_NAME = "stmt-payment-lists__shop"
+ITEM_AMOUNT_CLASS_NAME = "stmt-payment-lists__amount"
+# 明細が複数ページに分かれている場合の「次へ」のリンク
+NEXT_PAGE_CLASS_NAME = "stmt-pager__next"
+
+# 一度の解析でまとめて渡すHTMLの大きさ (文字数)
+_CHUNK_SIZE = 64 * 1024
+
+# ブラウザ内で明細をまとめて取り出すスクリプト (関数の定義のみ)。
+# WebDriverの1回の呼び出しで合計金額、お支払い日、利用明細、次ページのURLと、表示中のカードの値を返す。
+EXTRACT_STATEMENT_JS = f"""
+const extractStatement = () => {{
+    const text = el => el ? el.textContent.trim() : null;
+    const amount = document.querySelector('.{AMOUNT_CLASS_NAME} .{AMOUNT_SPAN_CLASS_NAME}');
+    const next = document.querySelector('a.{NEXT_PAGE_CLASS_NAME}, a[rel="next"]');
+    const select = document.getElementById('{CARD_SELECT_ID}');
+    return {{
+        card: select ? select.value : null,
+        total: text(amount),
+        payment_date: text(document.querySelector('.{PAYMENT_DATE_CLASS_NAME}')),
+        items: Array.from(document.querySelectorAll('.{ITEM_ROW_CLASS_NAME}')).map(row => ({{
+            date: text(row.querySelector('.{ITEM_DATE_CLASS_NAME}')),
+            shop: text(row.querySelector('.{ITEM_SHOP_CLASS_NAME}')),
+            amount: text(row.querySelector('.{ITEM_AMOUNT_CLASS_NAME}')),
+        }})),
+        next_url: next ? next.href : null,
+    }};
+}};
+"""
+
+
+class CardMismatchError(ValueError):
+    """明細ページが、取得しようとしたカードとは別のカードを表示している"""
+
+
+def check_selected_card(selected_value, card_value):
+    """
+    明細ページで選択中のカードの値が card_value でなければ CardMismatchError を送出する。
+    カードの切り替えが無視されると元のカードの明細が返るので、別のカードの金額として扱わないようにする
+    """
+    if selected_value != card_value:
+        raise CardMismatchError(f"明細ページが value '{card_value}' ではなく '{selected_value}' のカードを表示しています。")
+
+
+def parse_amount_text(amount_text):
+    """'12,345' のような金額テキストを数値に変換する。変換できなければNone"""
+    print(f"抽出された金額テキスト: {amount_text}")
+    try:
+        numeric_amount = int(amount_text.replace(',', ''))
+        print(f"数値として変換された金額: {numeric_amount}")
+        return numeric_amount
+    except (ValueError, AttributeError):
+        print(f"エラー: 金額を数値に変換できませんでした: '{amount_text}'")
+        return None
+
+
+def _to_yen(text):
+    """利用明細の金額 ('1,234円' や '-500') を数値に変換する。変換できなければNone"""
+    if not text:
+        return None
+    try:
+        return int(text.replace(',', '').replace('円', '').replace('¥', '').strip())
+    except ValueError:
+        return None
+
+
+def _to_item(date, shop, amount):
+    return {"date": date, "shop": shop, "amount": _to_yen(amount), "amount_text": amount}
+
+
+def _has_class(element, class_name):
+    return class_name in (element.get("class") or "").split()
+
+
+def _text(element):
+    """要素内のテキストを空白を詰めて返す"""
+    return " ".join("".join(element.itertext()).split())
+
+
+def _find_text(element, class_name):
+    """子孫の中から class_name を持つ要素のテキストを返す"""
+    for child in element.iter():
+        if _has_class(child, class_name):
+            return _text(child)
+    return None
+
+
+def iter_statement_html(html_chunks):
+    """
+    明細ページのHTMLを (文字列の断片のイテレータとして) 受け取り、解析できたものから順に
+    ('total', 金額テキスト) / ('payment_date', 日付) / ('item', 明細の1行) / ('next_url', URL) を返す。
+    ツリー全体を作らず、読み終えた明細の行はメモリから解放する。
+    """
+    if isinstance(html_chunks, str):
+        html = html_chunks
+        html_chunks = (html[i:i + _CHUNK_SIZE] for i in range(0, len(html), _CHUNK_SIZE))
+
+    parser = etree.HTMLPullParser(events=("end",))
+    for chunk in html_chunks:
+        parser.feed(chunk)
+        yield from _read_events(parser)
+    parser.close()
+    yield from _read_events(parser)
+
+
+def _read_events(parser):
+    for _, element in parser.read_events():
+        if not isinstance(element.tag, str):
+            continue
+        if _has_class(element, AMOUNT_SPAN_CLASS_NAME) and any(
+            _has_class(a, AMOUNT_CLASS_NAME) for a in element.iterancestors()
+        ):
+            yield "total", _text(element)
+        elif _has_class(element, PAYMENT_DATE_CLASS_NAME):
+            yield "payment_date", _text(element)
+        elif _has_class(element, ITEM_ROW_CLASS_NAME):
+            yield "item", _to_item(
+                _find_text(element, ITEM_DATE_CLASS_NAME),
+                _find_text(element, ITEM_SHOP_CLASS_NAME),
+                _find_text(element, ITEM_AMOUNT_CLASS_NAME),
+            )
+            # 読み終えた行と、それより前の兄弟要素を解放する
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        elif element.tag == "a" and (_has_class(element, NEXT_PAGE_CLASS_NAME) or element.get("rel") == "next"):
+            yield "next_url", element.get("href")
+
+
+def parse_statement_html(html):
+    """明細ページのHTMLから合計金額、お支払い日、利用明細、次ページのURLを取り出す"""
+    statement = {"total": None, "payment_date": None, "items": [], "next_url": None}
+    for kind, value in iter_statement_html(html):
+        if kind == "item":
+            statement["items"].append(value)
+        elif statement[kind] is None:
+            statement[kind] = value
+    statement["total"] = parse_amount_text(statement["total"])
+    return statement
+
+
+def parse_money_amount(html):
+    """明細ページ (または金額のdiv要素) のHTMLからお支払い金額を取り出す。見つかった時点で解析をやめる"""
+    for kind, value in iter_statement_html(html):
+        if kind == "total":
+            return parse_amount_text(value)
+    print("エラー: 指定されたspanタグが見つかりませんでした。")
+    return None
+
+
+def from_extracted(payload):
+    """EXTRACT_STATEMENT_JS の結果を parse_statement_html と同じ形に変換する"""
+    return {
+        "total": parse_amount_text(payload["total"]),
+        "payment_date": payload["payment_date"],
+        "items": [_to_item(i["date"], i["shop"], i["amount"]) for i in payload["items"]],
+        "next_url": payload["next_url"],
+        "card": payload["card"],
+    }
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import hashlib
+
+from tracing import record
+
+# ステップごとの再試行の回数。STEP_RETRIES_<ステップ名> の環境変数で上書きできる
+# (card はカード1枚ごとの回数。失敗してもブラウザやログインはやり直さない)
+DEFAULT_STEP_RETRIES = {
+    "launch": 1,
+    "login": 1,
+    "welcome": 1,
+    "statement": 1,
+    "card": 2,
+    # Slackへの送信の再試行は delivery が行う
+    "notify": 0,
+}
+# 途中で失敗した実行の結果を置いておく場所
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "/tmp/enavi_checkpoint")
+# この時間より古いチェックポイントは次の実行で使わない (秒)
+CHECKPOINT_MAX_AGE_SEC = int(os.getenv("CHECKPOINT_MAX_AGE_SEC", "600"))
+# 次の実行に引き継ぐステップ (ブラウザに結びついたステップは新しい実行ではやり直す)
+_PERSISTENT_PREFIXES = ("card:",)
+
+
+class StepFailed(Exception):
+    """ステップが再試行の回数を使い切っても成功しなかった"""
+
+    def __init__(self, step, error, attempts):
+        super().__init__(f"ステップ '{step}' が{attempts}回試行しても成功しませんでした: {type(error).__name__}: {error}")
+        self.step = step
+        self.error = error
+        self.attempts = attempts
+
+
+def step_retries(step):
+    """ステップの再試行の回数を返す ('card:2' のようなステップは 'card' の設定を使う)"""
+    kind = step.split(":", 1)[0]
+    value = os.getenv(f"STEP_RETRIES_{kind.upper()}")
+    if value:
+        return int(value)
+    return DEFAULT_STEP_RETRIES.get(kind, 0)
+
+
+class Checkpoint:
+    """
+    完了したステップの出力を保持する。カードの結果は/tmpにも書き出し、
+    途中で失敗した実行の次の実行 (ウォームスタート) では取得済みのカードを取り直さない。
+    """
+
+    def __init__(self, account=None):
+        self.account = account
+        self.outputs = {}
+
+    def _path(self):
+        name = hashlib.sha256(f"{self.account or ''}".encode("utf-8")).hexdigest()[:24]
+        return os.path.join(CHECKPOINT_DIR, f"{name}.json")
+
+    @classmethod
+    def load(cls, account=None):
+        """前回の実行が途中で失敗していれば、その時点までのカードの結果を引き継ぐ"""
+        checkpoint = cls(account)
+        path = checkpoint._path()
+        if not os.path.exists(path):
+            return checkpoint
+        try:
+            with open(path, encoding="utf-8") as f:
+                payload = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"チェックポイントの読み込みに失敗しました: {e}")
+            return checkpoint
+        if time.time() - payload.get("saved_at", 0) > CHECKPOINT_MAX_AGE_SEC:
+            checkpoint.clear()
+            return checkpoint
+        checkpoint.outputs = payload.get("outputs", {})
+        if checkpoint.outputs:
+            print(f"前回の実行のチェックポイントを引き継ぎます: {sorted(checkpoint.outputs)}")
+        return checkpoint
+
+    def done(self, step):
+        return step in self.outputs
+
+    def get(self, step):
+        return self.outputs.get(step)
+
+    def complete(self, step, output):
+        """ステップの出力を記録する。次の実行に引き継ぐステップならファイルにも書き出す"""
+        self.outputs[step] = output
+        if step.startswith(_PERSISTENT_PREFIXES):
+            self._save()
+
+    def _save(self):
+        persistent = {k: v for k, v in self.outputs.items() if k.startswith(_PERSISTENT_PREFIXES)}
+        try:
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            with open(self._path(), "w", encoding="utf-8") as f:
+                json.dump({"saved_at": time.time(), "outputs": persistent}, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"チェックポイントの保存に失敗しました: {e}")
+
+    def clear(self):
+        """実行が最後まで完了したらチェックポイントを消す"""
+        self.outputs = {}
+        path = self._path()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run_step(checkpoint, step, fn, on_retry=None, retries=None):
+    """
+    ステップを実行し、出力をチェックポイントに記録して返す。完了済みのステップは実行しない。
+    失敗したらこのステップだけを再試行の回数まで繰り返す (on_retry で再試行前の後始末をする)。
+    回数を使い切ったら StepFailed を送出する。
+    """
+    if checkpoint.done(step):
+        return checkpoint.get(step)
+
+    retries = step_retries(step) if retries is None else retries
+    for attempt in range(retries + 1):
+        started = time.perf_counter()
+        try:
+            output = fn()
+        except Exception as e:
+            # 成功した試行の所要時間は各ステップの中のスパンで記録しているので、失敗だけを記録する
+            record("step_failure", (time.perf_counter() - started) * 1000, "error", step=step, attempt=attempt, error=type(e).__name__)
+            if attempt >= retries:
+                raise StepFailed(step, e, attempt + 1) from e
+            print(f"ステップ '{step}' が失敗しました。再試行します ({attempt + 1}/{retries}): {type(e).__name__}: {e}")
+            if on_retry:
+                try:
+                    on_retry(e)
+                except Exception as cleanup_error:
+                    raise StepFailed(step, cleanup_error, attempt + 1) from cleanup_error
+            continue
+        checkpoint.complete(step, output)
+        return output
@@ -1,6 +1,4 @@
 import main
 
 if __name__ == "__main__":
-    main.lambda_handler("", "")
-    
-
+    main.handler({}, None)
@@ -0,0 +1,125 @@
+import os
+import json
+import math
+import time
+import uuid
+from contextlib import contextmanager
+
+# 出力形式: json (1行1スパンのJSONログ) / emf (CloudWatch Embedded Metric Format)
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "json")
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "RakutenCardScraper")
+
+# --- 実行中のrun IDと、ローカル集計用のフェーズごとの所要時間 ---
+_run_id = None
+_durations = {}
+# 実行中のrunで記録したスパン (履歴の保存に使う)
+_run_spans = []
+# ローカル集計はローカル実行でだけ表示する (Lambdaではログのスパンから集計する)
+_IN_LAMBDA = bool(os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+
+
+def start_run(run_id=None):
+    """新しい実行のrun IDを設定する (Lambdaでは aws_request_id を使う)"""
+    global _run_id
+    _run_id = run_id or uuid.uuid4().hex
+    _run_spans.clear()
+    if _IN_LAMBDA:
+        # ローカル集計は表示しないので、ウォームなコンテナで実行ごとに溜め続けない
+        _durations.clear()
+    return _run_id
+
+
+def current_run_id():
+    """実行中のrun IDを返す"""
+    return _run_id or start_run()
+
+
+def _emit(phase, duration_ms, status, attrs):
+    """スパンを1行のログとして出力する"""
+    if METRICS_FORMAT == "emf":
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [["Phase"], ["Phase", "Status"]],
+                    "Metrics": [{"Name": "Duration", "Unit": "Milliseconds"}],
+                }],
+            },
+            "Phase": phase,
+            "Status": status,
+            "Duration": duration_ms,
+            "RunId": current_run_id(),
+            **attrs,
+        }
+    else:
+        record = {
+            "type": "span",
+            "run_id": current_run_id(),
+            "phase": phase,
+            "duration_ms": duration_ms,
+            "status": status,
+            **attrs,
+        }
+    print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def record(phase, duration_ms, status="ok", **attrs):
+    """計測済みの所要時間をスパンとして記録する"""
+    duration_ms = round(duration_ms, 1)
+    _durations.setdefault(phase, []).append(duration_ms)
+    _run_spans.append({"phase": phase, "duration_ms": duration_ms, "status": status})
+    _emit(phase, duration_ms, status, attrs)
+
+
+@contextmanager
+def span(phase, **attrs):
+    """with ブロックの所要時間をフェーズとして記録する。例外時は status=error で記録する"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        record(phase, (time.perf_counter() - started) * 1000, status, **attrs)
+
+
+def run_spans():
+    """実行中のrunで記録したスパンのリストを返す"""
+    return list(_run_spans)
+
+
+def _percentile(values, percent):
+    """ソート済みの値から最近傍法でパーセンタイルを求める"""
+    index = max(0, math.ceil(percent / 100 * len(values)) - 1)
+    return values[index]
+
+
+def summarize():
+    """これまでに記録したフェーズごとの回数、p50、p95 (ミリ秒) を返す"""
+    summary = {}
+    for phase, values in _durations.items():
+        values = sorted(values)
+        summary[phase] = {
+            "count": len(values),
+            "p50_ms": _percentile(values, 50),
+            "p95_ms": _percentile(values, 95),
+        }
+    return summary
+
+
+def print_summary():
+    """フェーズごとの集計を表形式で表示する (ローカル実行用)"""
+    summary = summarize()
+    if not summary:
+        return
+    print(f"{'phase':<28}{'count':>6}{'p50(ms)':>12}{'p95(ms)':>12}")
+    for phase, stats in summary.items():
+        print(f"{phase:<28}{stats['count']:>6}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}")
+
+
+def reset():
+    """ローカル集計をクリアする"""
+    _durations.clear()